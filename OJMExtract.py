@@ -1,64 +1,66 @@
-import copy
 import os
 import math
+import time
 import struct
+import numpy as np
 
 # a python implementation of the ojm dumper based on information from open2jam
 class OJMExtract():
     def __init__(self):   
         # the xor mask used in the M30 format
-        # ["6E", "61", "6D", "69"] = ["n", "a", "m", "i"], hence the name
+        # [0x6E, 0x61, 0x6D, 0x69] = ["n", "a", "m", "i"], hence the name
         # Further explanation: hex(ord("n")) = '0x6e'
-        self.nami = ["6E", "61", "6D", "69"]
+        self.nami = b"nami"
 
-        # the M30 signature", "M30\0" in little endian
-        self.M30_SIGNATURE = "0030334D"
+        # the M30 signature, "M30\0" (0x0030334D in little endian)
+        self.M30_SIGNATURE = b"M30\x00"
 
-        # the OMC signature", "OMC\0" in little endian
-        self.OMC_SIGNATURE = "00434D4F"
+        # the OMC signature, "OMC\0" (0x00434D4F in little endian)
+        self.OMC_SIGNATURE = b"OMC\x00"
 
-        # the OJM signature", "OJM\0" in little endian
-        self.OJM_SIGNATURE = "004D4A4F"
+        # the OJM signature, "OJM\0" (0x004D4A4F in little endian)
+        self.OJM_SIGNATURE = b"OJM\x00"
 
         # this is a dump from debugging notetool
+        # every row of 17 entries (starting at key = 17 * (length % 17)) is a permutation of the 17 blocks
         self.REARRANGE_TABLE = [
-            "10", "0E", "02", "09", "04", "00", "07", "01",
-            "06", "08", "0F", "0A", "05", "0C", "03", "0D",
-            "0B", "07", "02", "0A", "0B", "03", "05", "0D",
-            "08", "04", "00", "0C", "06", "0F", "0E", "10",
-            "01", "09", "0C", "0D", "03", "00", "06", "09",
-            "0A", "01", "07", "08", "10", "02", "0B", "0E",
-            "04", "0F", "05", "08", "03", "04", "0D", "06",
-            "05", "0B", "10", "02", "0C", "07", "09", "0A",
-            "0F", "0E", "00", "01", "0F", "02", "0C", "0D",
-            "00", "04", "01", "05", "07", "03", "09", "10",
-            "06", "0B", "0A", "08", "0E", "00", "04", "0B",
-            "10", "0F", "0D", "0C", "06", "05", "07", "01",
-            "02", "03", "08", "09", "0A", "0E", "03", "10",
-            "08", "07", "06", "09", "0E", "0D", "00", "0A",
-            "0B", "04", "05", "0C", "02", "01", "0F", "04",
-            "0E", "10", "0F", "05", "08", "07", "0B", "00",
-            "01", "06", "02", "0C", "09", "03", "0A", "0D",
-            "06", "0D", "0E", "07", "10", "0A", "0B", "00",
-            "01", "0C", "0F", "02", "03", "08", "09", "04",
-            "05", "0A", "0C", "00", "08", "09", "0D", "03",
-            "04", "05", "10", "0E", "0F", "01", "02", "0B",
-            "06", "07", "05", "06", "0C", "04", "0D", "0F",
-            "07", "0E", "08", "01", "09", "02", "10", "0A",
-            "0B", "00", "03", "0B", "0F", "04", "0E", "03",
-            "01", "00", "02", "0D", "0C", "06", "07", "05",
-            "10", "09", "08", "0A", "03", "02", "01", "00",
-            "04", "0C", "0D", "0B", "10", "05", "06", "0F",
-            "0E", "07", "09", "0A", "08", "09", "0A", "00",
-            "07", "08", "06", "10", "03", "04", "01", "02",
-            "05", "0B", "0E", "0F", "0D", "0C", "0A", "06",
-            "09", "0C", "0B", "10", "07", "08", "00", "0F",
-            "03", "01", "02", "05", "0D", "0E", "04", "0D",
-            "00", "01", "0E", "02", "03", "08", "0B", "07",
-            "0C", "09", "05", "0A", "0F", "04", "06", "10",
-            "01", "0E", "02", "03", "0D", "0B", "07", "00",
-            "08", "0C", "09", "06", "0F", "10", "05", "0A",
-            "04", "00"
+            0x10, 0x0E, 0x02, 0x09, 0x04, 0x00, 0x07, 0x01,
+            0x06, 0x08, 0x0F, 0x0A, 0x05, 0x0C, 0x03, 0x0D,
+            0x0B, 0x07, 0x02, 0x0A, 0x0B, 0x03, 0x05, 0x0D,
+            0x08, 0x04, 0x00, 0x0C, 0x06, 0x0F, 0x0E, 0x10,
+            0x01, 0x09, 0x0C, 0x0D, 0x03, 0x00, 0x06, 0x09,
+            0x0A, 0x01, 0x07, 0x08, 0x10, 0x02, 0x0B, 0x0E,
+            0x04, 0x0F, 0x05, 0x08, 0x03, 0x04, 0x0D, 0x06,
+            0x05, 0x0B, 0x10, 0x02, 0x0C, 0x07, 0x09, 0x0A,
+            0x0F, 0x0E, 0x00, 0x01, 0x0F, 0x02, 0x0C, 0x0D,
+            0x00, 0x04, 0x01, 0x05, 0x07, 0x03, 0x09, 0x10,
+            0x06, 0x0B, 0x0A, 0x08, 0x0E, 0x00, 0x04, 0x0B,
+            0x10, 0x0F, 0x0D, 0x0C, 0x06, 0x05, 0x07, 0x01,
+            0x02, 0x03, 0x08, 0x09, 0x0A, 0x0E, 0x03, 0x10,
+            0x08, 0x07, 0x06, 0x09, 0x0E, 0x0D, 0x00, 0x0A,
+            0x0B, 0x04, 0x05, 0x0C, 0x02, 0x01, 0x0F, 0x04,
+            0x0E, 0x10, 0x0F, 0x05, 0x08, 0x07, 0x0B, 0x00,
+            0x01, 0x06, 0x02, 0x0C, 0x09, 0x03, 0x0A, 0x0D,
+            0x06, 0x0D, 0x0E, 0x07, 0x10, 0x0A, 0x0B, 0x00,
+            0x01, 0x0C, 0x0F, 0x02, 0x03, 0x08, 0x09, 0x04,
+            0x05, 0x0A, 0x0C, 0x00, 0x08, 0x09, 0x0D, 0x03,
+            0x04, 0x05, 0x10, 0x0E, 0x0F, 0x01, 0x02, 0x0B,
+            0x06, 0x07, 0x05, 0x06, 0x0C, 0x04, 0x0D, 0x0F,
+            0x07, 0x0E, 0x08, 0x01, 0x09, 0x02, 0x10, 0x0A,
+            0x0B, 0x00, 0x03, 0x0B, 0x0F, 0x04, 0x0E, 0x03,
+            0x01, 0x00, 0x02, 0x0D, 0x0C, 0x06, 0x07, 0x05,
+            0x10, 0x09, 0x08, 0x0A, 0x03, 0x02, 0x01, 0x00,
+            0x04, 0x0C, 0x0D, 0x0B, 0x10, 0x05, 0x06, 0x0F,
+            0x0E, 0x07, 0x09, 0x0A, 0x08, 0x09, 0x0A, 0x00,
+            0x07, 0x08, 0x06, 0x10, 0x03, 0x04, 0x01, 0x02,
+            0x05, 0x0B, 0x0E, 0x0F, 0x0D, 0x0C, 0x0A, 0x06,
+            0x09, 0x0C, 0x0B, 0x10, 0x07, 0x08, 0x00, 0x0F,
+            0x03, 0x01, 0x02, 0x05, 0x0D, 0x0E, 0x04, 0x0D,
+            0x00, 0x01, 0x0E, 0x02, 0x03, 0x08, 0x0B, 0x07,
+            0x0C, 0x09, 0x05, 0x0A, 0x0F, 0x04, 0x06, 0x10,
+            0x01, 0x0E, 0x02, 0x03, 0x0D, 0x0B, 0x07, 0x00,
+            0x08, 0x0C, 0x09, 0x06, 0x0F, 0x10, 0x05, 0x0A,
+            0x04, 0x00
         ]
 
         self.acc_keybyte = 0xFF
@@ -71,164 +73,211 @@ class OJMExtract():
         self.enc = None
         self.song_path = None
         self.debug = False
-        # This will be passed when dump_file() is called
+        # This will be passed when build_index() / dump_file() is called
         self.filename = None
         # for OJNExtract use {sample_id (int): extension ("wav" or "ogg")}
         self.sound_dict = {} 
-
-    # little-endian (LE), hexdata to hexstring
-    def LE(self, hexdata: list[str]) -> str:
-        hexdata.reverse()
-        return "".join(hexdata).upper()
-
-    # big-endian (BE), hexdata to hexstring
-    def BE(self, hexdata: list[str]) -> str:
-        return "".join(hexdata).upper()
-
-    # hexstring to float32
-    def SingleFloat(self, hexstring: str) -> float:
-        return struct.unpack("!f", bytes.fromhex(hexstring))[0]
+        # {sample_id (int): {"offset", "size", "codec", "encryption", ...}}, filled by build_index()
+        self.sample_index = {}
+        # keep extracted samples in sound_buffers instead of writing them to song_path
+        self.flag_in_memory = False
+        # {"normal-hitnormal1002.ogg": bytes}, filled by extract_samples() when flag_in_memory is set
+        self.sound_buffers = {}
 
     # Get effective section of null-terminated string (ends with x00)
-    def NUL_String(self, hexdata: list[str]) -> list[str]:
-        for idx in range(len(hexdata)):
-            if hexdata[idx] == "00":
-                return hexdata[0:idx]
-        return hexdata
-
-    # convert text to hex
-    # e.g. "RIFF" -> ['52', '49', '46', '46']
-    def text_to_hex(self, text: str) -> list[str]:
-        return [hex(ord(x))[2:] for x in text]
-
-    # convert int to hex
-    # e.g. 132336 -> '0x204f0' -> ['F0', '04', '02', '00']
-    def int_to_hex(self, num: int, fill=8, LE=True) -> list[str]:
-        hex_raw = hex(num)[2:].zfill(fill)
-        hexdata = [hex_raw[i:i+2] for i in range(0, len(hex_raw), 2)]
-        if LE:
-            hexdata.reverse()
-        return hexdata
+    def NUL_String(self, data: bytes) -> bytes:
+        return bytes(data).split(b"\x00", 1)[0]
 
     # nami decryption for M30 format
-    def nami_xor(self, hexdata):
-        for i in range(0, len(hexdata) - 3, 4):
-            hexdata[i+0] = hex(int(hexdata[i+0], 16) ^ int(self.nami[0], 16))[2:].zfill(2)
-            hexdata[i+1] = hex(int(hexdata[i+1], 16) ^ int(self.nami[1], 16))[2:].zfill(2)
-            hexdata[i+2] = hex(int(hexdata[i+2], 16) ^ int(self.nami[2], 16))[2:].zfill(2)
-            hexdata[i+3] = hex(int(hexdata[i+3], 16) ^ int(self.nami[3], 16))[2:].zfill(2)
+    # xor every whole 4-byte word with the mask in one go (a trailing partial word is left as it is)
+    def nami_xor(self, data: bytes) -> bytes:
+        words = len(data) // 4
+        key = np.frombuffer(self.nami, dtype="<u4")[0]
+        decoded = np.frombuffer(data, dtype="<u4", count=words) ^ key
+        return decoded.tobytes() + bytes(data[words * 4:])
     
     
     # 1st decryption for OMC_WAV
-    def rearrange(self, buf_encoded):
+    # buf_encoded -> bytes / bytearray / memoryview
+    def rearrange(self, buf_encoded) -> bytearray:
         length = len(buf_encoded)
         key = ((length % 17) << 4) + (length % 17)
 
-        block_size = int(length / 17)
+        block_size = length // 17
+        buf_encoded = memoryview(buf_encoded)
 
-        # Let's fill the buffer
-        buf_plain = copy.deepcopy(buf_encoded)
+        # Let's fill the buffer (the remainder after the 17 blocks is never moved)
+        buf_plain = bytearray(length)
+        buf_plain[block_size * 17:] = buf_encoded[block_size * 17:]
 
         # loopy loop
         for block in range(17):
             # Where is the start of the enconded block
             block_start_encoded = block_size * block
             # Where the final plain block will be
-            block_start_plain = block_size * int(self.REARRANGE_TABLE[key], 16)
+            block_start_plain = block_size * self.REARRANGE_TABLE[key]
             buf_plain[block_start_plain:block_start_plain + block_size] = buf_encoded[block_start_encoded:block_start_encoded + block_size]
             key += 1
         
         return buf_plain
 
     # 2nd decryption for OMC_WAV
-    def acc_xor(self, buf):
-        temp = 0
-        this_byte = 0
-
-        for i in range(len(buf)):
-            temp = this_byte = int(buf[i], 16)
-
-            if ((self.acc_keybyte << self.acc_counter) & 0x80) != 0:
-                this_byte = 255 - this_byte
-
-            buf[i] = hex(this_byte)[2:].upper().zfill(2)
-            self.acc_counter += 1
-            if self.acc_counter > 7:
-                self.acc_counter = 0
-                self.acc_keybyte = temp
-        return buf
+    # byte i is inverted when bit (7 - counter) of the key byte is set, counter = (acc_counter + i) % 8
+    # the key byte of every group of 8 bytes is the last *encoded* byte of the previous group,
+    # so all the keys are known from the input and the whole buffer can be decoded at once
+    # acc_keybyte and acc_counter carry over to the next sample
+    def acc_xor(self, buf: bytes) -> bytes:
+        data = np.frombuffer(buf, dtype=np.uint8)
+        if len(data) == 0:
+            return b""
+
+        counter = self.acc_counter
+        positions = np.arange(len(data)) + counter
+        # group 0 uses the current key byte, group g uses the byte right before it (index 8g - counter - 1)
+        group_ends = data[7 - counter::8]
+        keys = np.concatenate(([self.acc_keybyte], group_ends)).astype(np.uint8)
+        flip = (keys[positions >> 3] >> (7 - (positions & 7))) & 1
+        decoded = data ^ (flip * 0xFF).astype(np.uint8)
+
+        self.acc_counter = (counter + len(data)) % 8
+        if len(group_ends) > 0:
+            self.acc_keybyte = int(group_ends[-1])
+        return decoded.tobytes()
+
+    # find where byte `pos` of the rearranged (plain) buffer comes from in the encoded buffer
+    def rearrange_source(self, length, pos):
+        block_size = length // 17
+        if pos >= block_size * 17:
+            return pos
+        key = ((length % 17) << 4) + (length % 17)
+        block = self.REARRANGE_TABLE.index(pos // block_size, key, key + 17) - key
+        return block_size * block + pos % block_size
 
-    def dump_file(self, filename):
+    # 1st pass: read every sample header and skip over the payloads
+    # sample_index -> {sample_id: {"offset", "size", "codec", "encryption", ...}}
+    # Nothing is decoded or written here, see extract_samples()
+    def build_index(self, filename):
         self.filename = filename # useful for debug
+        self.sample_index = {}
+        self.sound_dict = {}
         
         # Compare signature (M30, OMC, OJM)
-        ojn_filename = os.path.join(self.input_path, filename)
-        with open(ojn_filename, "rb") as f:
-            hex_raw = f.read().hex()
-
-        self.hexdata = [hex_raw[i:i+2] for i in range(0, len(hex_raw), 2)]
-
-        signature = self.LE(self.hexdata[0:4])
-
-        if signature == self.M30_SIGNATURE:
-            print("Extract M30 format audio files...")
-            self.parse_M30()
-        # OMC and OJM can be parsed by the same scheme
-        elif signature == self.OMC_SIGNATURE or signature == self.OJM_SIGNATURE:
-            print("Extract OMC/OJM format audio files...")
-            self.parse_OMC()
-        else:
-            print("Unknown Signature!")
-
-    def parse_M30(self):
+        ojm_filename = os.path.join(self.input_path, filename)
+        with open(ojm_filename, "rb") as f:
+            self.file_size = os.fstat(f.fileno()).st_size
+            signature = f.read(4)
+
+            if signature == self.M30_SIGNATURE:
+                print("Index M30 format audio files...")
+                self.index_M30(f)
+            # OMC and OJM can be parsed by the same scheme
+            elif signature == self.OMC_SIGNATURE or signature == self.OJM_SIGNATURE:
+                print("Index OMC/OJM format audio files...")
+                self.index_OMC(f)
+            else:
+                print("Unknown Signature!")
+
+        for sample_id, entry in self.sample_index.items():
+            self.sound_dict[sample_id] = entry["codec"]
+
+    # 2nd pass: decode and write the requested samples (all of them if sample_ids is None)
+    # Samples are read one at a time, so memory is bounded by the largest sample
+    def extract_samples(self, sample_ids=None):
+        if sample_ids is None:
+            sample_ids = self.sample_index.keys()
+        entries = [(sample_id, self.sample_index[sample_id]) for sample_id in sample_ids if sample_id in self.sample_index]
+        # read in file order
+        entries.sort(key=lambda x: x[1]["offset"])
+        print(f"Extract {len(entries)} of {len(self.sample_index)} audio files...")
+
+        # nami decryption throughput
+        nami_bytes = 0
+        nami_time = 0
+
+        ojm_filename = os.path.join(self.input_path, self.filename)
+        with open(ojm_filename, "rb") as f:
+            for sample_id, entry in entries:
+                f.seek(entry["offset"])
+                sample_bytes = f.read(entry["size"])
+
+                if entry["encryption"] == "nami":
+                    start_time = time.perf_counter()
+                    sample_bytes = self.nami_xor(sample_bytes)
+                    nami_time += time.perf_counter() - start_time
+                    nami_bytes += len(sample_bytes)
+                elif entry["encryption"] == "omc":
+                    self.acc_keybyte = entry["acc_keybyte"]
+                    self.acc_counter = entry["acc_counter"]
+                    sample_bytes = self.wav_header(*entry["wav_header"]) + self.acc_xor(self.rearrange(sample_bytes))
+
+                sample_filename = f"normal-hitnormal{sample_id}.{entry['codec']}"
+                if self.debug:
+                    print(f"Extract {sample_filename}")
+                if self.flag_in_memory:
+                    self.sound_buffers[sample_filename] = sample_bytes
+                else:
+                    with open(os.path.join(self.song_path, sample_filename), "wb") as f_out:
+                        f_out.write(sample_bytes)
+
+        if nami_bytes > 0:
+            print(f"nami decryption: {nami_bytes / 1e6:.2f} MB in {nami_time:.3f}s ({nami_bytes / 1e6 / max(nami_time, 1e-9):.1f} MB/s)")
+
+    # extract every sample in the OJM
+    def dump_file(self, filename):
+        self.build_index(filename)
+        self.extract_samples()
+
+    # wav_header
+    # https://stackoverflow.com/questions/28137559/can-someone-explain-wavwave-file-headers
+    def wav_header(self, audio_format, num_channels, sample_rate, bit_rate, block_align, bits_per_sample, chunk_size) -> bytes:
+        return struct.pack(
+            "<4sI4s4sIHHIIHH4sI",
+            b"RIFF", chunk_size + 36, b"WAVE",
+            b"fmt ", 16, audio_format, num_channels, sample_rate, bit_rate, block_align, bits_per_sample,
+            b"data", chunk_size
+        )
+
+    # f -> ojm file object, positioned right after the signature
+    def index_M30(self, f):
         # M30_header (28 bytes)
-        file_format_version = int(self.LE(self.hexdata[4:8]), 16)
-        encryption_flag = int(self.LE(self.hexdata[8:12]), 16)
-        sample_count = int(self.LE(self.hexdata[12:16]), 16) # Do not use this because it might not be accurate
-        samples_offset = int(self.LE(self.hexdata[16:20]), 16)
-        payload_size = int(self.LE(self.hexdata[20:24]), 16)
-        padding = int(self.LE(self.hexdata[24:28]), 16)
+        file_format_version, encryption_flag, sample_count, samples_offset, payload_size, padding = struct.unpack("<6I", f.read(24))
+        # sample_count - Do not use this because it might not be accurate
 
         pos = 28
 
-        # reset global variables
-        self.acc_keybyte = 0xFF
-        self.acc_counter = 0
+        # check encryption flag
+        # 16 - nami
+        if encryption_flag == 16:
+            encryption = "nami"
+        # flag > 16 should be plain ogg according to documentation
+        elif encryption_flag > 16:
+            encryption = "none"
+        # 1 - scramble1; 2 - scramble2; 4 - decode; 8 - decrypt; 
+        else:
+            encryption = None
         
         # ogg data section
         for i in range(sample_count):
             # reached the end of the file before the samples_count
-            if len(self.hexdata) - pos < 52:
+            if self.file_size - pos < 52:
                 print(f"Wrong number of samples on OJM header: {self.filename}")
                 break
             
             # M30_OGG_header (sample header, 52 bytes)
-            # sample_name = bytes.fromhex(self.BE(self.NUL_String(self.hexdata[pos:pos+32]))).decode(self.enc)
-            sample_size = int(self.LE(self.hexdata[pos+32:pos+36]), 16)
-            codec_code = int(self.LE(self.hexdata[pos+36:pos+38]), 16)
-            unk_fixed = int(self.LE(self.hexdata[pos+38:pos+40]), 16)
-            music_flag = int(self.LE(self.hexdata[pos+40:pos+44]), 16)
-            ref = (int(self.LE(self.hexdata[pos+44:pos+46]), 16))
-            unk_zero = int(self.LE(self.hexdata[pos+46:pos+48]), 16)
-            pcm_samples = int(self.LE(self.hexdata[pos+48:pos+52]), 16)
+            sample_name, sample_size, codec_code, unk_fixed, music_flag, ref, unk_zero, pcm_samples = struct.unpack("<32sIHHIHHI", f.read(52))
+            # sample_name = self.NUL_String(sample_name).decode(self.enc)
             pos += 52
 
             # to match OJN sample_id
             ref += 2
 
-            # ogg_data
-            ogg_data = self.hexdata[pos:pos+sample_size]
+            # ogg_data (the last sample might be cut short)
+            offset = pos
+            size = max(0, min(sample_size, self.file_size - offset))
             pos += sample_size
+            f.seek(pos)
 
-            # check encryption flag
-            # 16 - nami
-            if encryption_flag == 16:
-                self.nami_xor(ogg_data)
-            # flag > 16 should be plain ogg according to documentation
-            elif encryption_flag > 16:
-                pass
-            # 1 - scramble1; 2 - scramble2; 4 - decode; 8 - decrypt; 
-            else:
+            if encryption is None:
                 print(f"Unknown encryption flag {encryption_flag}, skipping!")
                 break
 
@@ -238,42 +287,34 @@ class OJMExtract():
             elif codec_code != 5:
                 print(f"Unknown sample id type {codec_code} on OJM: {self.filename}")
 
-            ogg_bytes = bytes.fromhex(self.BE(ogg_data))
-
-            ogg_filename = os.path.join(self.song_path, f"normal-hitnormal{ref}.ogg")
-            if self.debug:
-                print(f"Extract normal-hitnormal{ref}.ogg")
-            if len(ogg_bytes) > 0:
-                with open(ogg_filename, "wb") as f:
-                    f.write(ogg_bytes)
-                self.sound_dict[ref] = "ogg"
+            if size > 0:
+                self.sample_index[ref] = {
+                    "offset": offset,
+                    "size": size,
+                    "codec": "ogg",
+                    "encryption": encryption
+                }
             else:
                 print(f"Failed normal-hitnormal{ref}.ogg")
             
     
-    def parse_OMC(self):
+    # f -> ojm file object, positioned right after the signature
+    def index_OMC(self, f):
         # OMC_header (20 bytes)
-        wav_count = int(self.LE(self.hexdata[4:6]), 16)
-        ogg_count = int(self.LE(self.hexdata[6:8]), 16)
-        wav_start = int(self.LE(self.hexdata[8:12]), 16)
-        ogg_start = int(self.LE(self.hexdata[12:16]), 16)
-        filesize = int(self.LE(self.hexdata[16:20]), 16)
+        wav_count, ogg_count, wav_start, ogg_start, filesize = struct.unpack("<HHIII", f.read(16))
 
         pos = 20
         sample_id = 2 # sample_id starts from 2
+
+        # acc_xor state carries over from one wav to the next, so remember it at the start of every wav
+        acc_keybyte = 0xFF
+        acc_counter = 0
         
         # wav data section
         while pos < ogg_start:
             # OMC_WAV_header (sample header, 56 bytes)
-            # sample_name = bytes.fromhex(self.BE(self.NUL_String(self.hexdata[pos:pos+32]))).decode(self.enc)
-            audio_format = int(self.LE(self.hexdata[pos+32:pos+34]), 16)
-            num_channels = int(self.LE(self.hexdata[pos+34:pos+36]), 16)
-            sample_rate = int(self.LE(self.hexdata[pos+36:pos+40]), 16)
-            bit_rate = int(self.LE(self.hexdata[pos+40:pos+44]), 16)
-            block_align = int(self.LE(self.hexdata[pos+44:pos+46]), 16)
-            bits_per_sample = int(self.LE(self.hexdata[pos+46:pos+48]), 16)
-            data = int(self.LE(self.hexdata[pos+48:pos+52]), 16)
-            chunk_size = int(self.LE(self.hexdata[pos+52:pos+56]), 16)
+            sample_name, audio_format, num_channels, sample_rate, bit_rate, block_align, bits_per_sample, data, chunk_size = struct.unpack("<32sHHIIHHII", f.read(56))
+            # sample_name = self.NUL_String(sample_name).decode(self.enc)
             pos += 56
 
             # skip empty chunk
@@ -281,38 +322,30 @@ class OJMExtract():
                 sample_id += 1
                 continue
 
-            # wav_data
-            wav_data = self.rearrange(self.hexdata[pos:pos+chunk_size])
-            wav_data = self.acc_xor(wav_data)
+            # wav_data (the last sample might be cut short)
+            offset = pos
+            size = max(0, min(chunk_size, self.file_size - offset))
             pos += chunk_size
 
-            # wav_header
-            # https://stackoverflow.com/questions/28137559/can-someone-explain-wavwave-file-headers
-            out_buffer = []
-            out_buffer += self.text_to_hex("RIFF")
-            out_buffer += self.int_to_hex(chunk_size+36)
-            out_buffer += self.text_to_hex("WAVE")
-            out_buffer += self.text_to_hex("fmt ")
-            out_buffer += self.int_to_hex(16)
-            out_buffer += self.int_to_hex(audio_format, fill=4)
-            out_buffer += self.int_to_hex(num_channels, fill=4)
-            out_buffer += self.int_to_hex(sample_rate)
-            out_buffer += self.int_to_hex(bit_rate)
-            out_buffer += self.int_to_hex(block_align, fill=4)
-            out_buffer += self.int_to_hex(bits_per_sample, fill=4)
-            out_buffer += self.text_to_hex("data")
-            out_buffer += self.int_to_hex(chunk_size)
-            out_buffer += wav_data
-
-            out_buffer_bytes = bytes.fromhex(self.BE(out_buffer))
-
-            wav_filename = os.path.join(self.song_path, f"normal-hitnormal{sample_id}.wav")
-            if len(out_buffer_bytes) > 0:
-                with open(wav_filename, "wb") as f:
-                    f.write(out_buffer_bytes)
-                self.sound_dict[sample_id] = "wav"
-            else:
-                print(f"Failed normal-hitnormal{sample_id}.wav")
+            self.sample_index[sample_id] = {
+                "offset": offset,
+                "size": size,
+                "codec": "wav",
+                "encryption": "omc",
+                "wav_header": (audio_format, num_channels, sample_rate, bit_rate, block_align, bits_per_sample, chunk_size),
+                "acc_keybyte": acc_keybyte,
+                "acc_counter": acc_counter
+            }
+
+            # advance the acc_xor state without decoding: the next key byte is the last
+            # (rearranged) encoded byte that completes a group of 8
+            last_key_pos = 7 - acc_counter
+            if size > last_key_pos:
+                last_key_pos += (size - 1 - last_key_pos) // 8 * 8
+                f.seek(offset + self.rearrange_source(size, last_key_pos))
+                acc_keybyte = f.read(1)[0]
+            acc_counter = (acc_counter + size) % 8
+            f.seek(pos)
             
             sample_id += 1
 
@@ -320,8 +353,8 @@ class OJMExtract():
         sample_id = 1002 # starts from 1002
         while pos < filesize:
             # OMC_OGG_header (sample header, 36 bytes)
-            # sample_name = bytes.fromhex(self.BE(self.NUL_String(self.hexdata[pos:pos+32]))).decode(self.enc)
-            sample_size = int(self.LE(self.hexdata[pos+32:pos+36]), 16)
+            sample_name, sample_size = struct.unpack("<32sI", f.read(36))
+            # sample_name = self.NUL_String(sample_name).decode(self.enc)
             pos += 36
 
             # skip empty sample
@@ -329,17 +362,19 @@ class OJMExtract():
                 sample_id += 1
                 continue
 
-                
-            ogg_data = self.hexdata[pos:pos+sample_size]
-            ogg_bytes = bytes.fromhex(self.BE(ogg_data))
+            offset = pos
+            size = max(0, min(sample_size, self.file_size - offset))
             pos += sample_size
-
-            ogg_filename = os.path.join(self.song_path, f"normal-hitnormal{sample_id}.ogg")
-            if len(ogg_bytes) > 0:
-                with open(ogg_filename, "wb") as f:
-                    f.write(ogg_bytes)
-                self.sound_dict[sample_id] = "ogg"
+            f.seek(pos)
+
+            if size > 0:
+                self.sample_index[sample_id] = {
+                    "offset": offset,
+                    "size": size,
+                    "codec": "ogg",
+                    "encryption": "none"
+                }
             else:
                 print(f"Failed normal-hitnormal{sample_id}.ogg")
             
-            sample_id += 1
\ No newline at end of file
+            sample_id += 1
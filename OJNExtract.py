@@ -1,8 +1,20 @@
+import io
 import os
+import json
 import math
-import copy
+import time
+import bisect
+import collections
+import mmap
 import struct
+import hashlib
+import traceback
+import contextlib
+import numpy as np
 import audio_lib
+import profile_lib
+import encoding_lib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from OJMExtract import OJMExtract
 
 class OJNExtract():
@@ -12,17 +24,68 @@ class OJNExtract():
         self.output_path = os.path.join(os.getcwd(), "output")
         self.settings()
         self.debug = False
+        # read-only mapping of the current .ojn (see open_ojn)
+        self.ojn_mmap = None
+        self.ojn_view = None
+        # ojn package header and event layout (see parse_diff)
+        self.package_header_dtype = np.dtype([("measure", "<u4"), ("channel", "<u2"), ("events", "<u2")])
+        self.package_event_dtype = np.dtype([("sample_value", "<u2"), ("volume_pan", "u1"), ("note_type", "u1")])
+        # parse_diff output, one read-only record array per diff
+        # note type -> 0 = rice; 1 = ln (measure_end is nan for rice)
+        # lane -> 0-6 (channel - 2)
+        # sample_volume -> 0-15, 0 = maximum
+        self.note_dtype = np.dtype([("type", "u1"), ("lane", "u1"), ("sample_value", "<i4"), ("sample_volume", "u1"), ("sample_pan", "u1"), ("measure_start", "<f8"), ("measure_end", "<f8")])
+        self.timing_dtype = np.dtype([("bpm", "<f8"), ("measure", "<f8")])
+        self.frac_measure_dtype = np.dtype([("measure", "<i8"), ("frac", "<f8")])
+        self.autoplay_dtype = np.dtype([("sample_id", "<i4"), ("sample_volume", "u1"), ("measure", "<f8")])
 
     def settings(self):
         '''Common Codecs
         gb18030 - Simplified Chinese
         big5 - Traditional Chinese
         euc_kr - Korean
+        auto - detect from the title / artist / noter bytes (see encoding_lib)
         '''
         self.enc = "euc_kr"
         self.flag_use_mp3 = True
+        # with flag_use_mp3, hand the extracted hitsounds straight to the mp3 encoder (no .ogg/.wav written to disk)
+        self.flag_in_memory = True
         self.flag_nsv = True
         self.extra_offset = -50
+        # number of songs converted in parallel (one process per song), 1 = convert one after another
+        self.workers = 1
+        # budget (bytes) of the decoded hitsound cache shared by all songs converted in the same process
+        self.pcm_cache_size = 512 * 1024 * 1024
+        # threads used inside a single song: hitsounds decoded at the same time by merge_mp3,
+        # and diffs whose mp3 is rendered at the same time by export_osu
+        self.decode_threads = 4
+        self.render_threads = 3
+        # max ffmpeg processes running at the same time in each process, None = cpu count / workers
+        self.ffmpeg_processes = None
+        # merge_mp3 mixes and encodes the song this many ms at a time (memory use grows with it)
+        self.mix_window_ms = 10000
+        # conversion manifest in output_path, a song is only converted again when its ojn/ojm,
+        # the settings below (get_output_settings) or its output files changed
+        self.manifest_filename = "o2jampy_manifest.json"
+        # JSON-lines file in output_path, one line per song with the wall / cpu time and tracemalloc peak
+        # of every stage (see profile_lib), None = no profiling (tracemalloc slows the conversion down)
+        self.profile_filename = None
+
+    # settings passed to the worker processes (see o2jam_to_osu)
+    def get_settings(self):
+        settings = ["enc", "flag_use_mp3", "flag_in_memory", "flag_nsv", "extra_offset", "debug", "input_path", "output_path", "pcm_cache_size", "profile_filename", "workers", "decode_threads", "render_threads", "ffmpeg_processes", "mix_window_ms"]
+        return {name: getattr(self, name) for name in settings}
+
+    # ffmpeg processes allowed in this process, so (workers x threads) doesn't start more ffmpeg than there are cores
+    def get_ffmpeg_limit(self):
+        if self.ffmpeg_processes is not None:
+            return self.ffmpeg_processes
+        return max(1, (os.cpu_count() or 1) // max(1, self.workers))
+
+    # settings that change the output files (recorded in the manifest)
+    def get_output_settings(self):
+        settings = ["enc", "flag_use_mp3", "flag_nsv", "extra_offset"]
+        return {name: getattr(self, name) for name in settings}
 
     # Just an example
     # More info: https://open2jam.wordpress.com/the-ojn-documentation/
@@ -91,27 +154,11 @@ class OJNExtract():
         clean_timings_flip = [list(t) for t in clean_timings_flip_dict.items()]
         return [[t[1], float(t[0])] for t in clean_timings_flip]
 
-    # little-endian (LE), hexdata to hexstring
-    def LE(self, hexdata: list[str]) -> str:
-        hexdata.reverse()
-        return "".join(hexdata)
-
-    # big-endian (BE), hexdata to hexstring
-    def BE(self, hexdata: list[str]) -> str:
-        return "".join(hexdata)
-
-    # hexstring to float32
-    def SingleFloat(self, hexstring: str) -> float:
-        return struct.unpack("!f", bytes.fromhex(hexstring))[0]
-
     # Get effective section of null-terminated string (ends with x00)
     # Can't simply remove all x00 because there might also be some useless gibberish included
     # e.g. CD F2 C8 41 E7 52 00 00 11 84 D8 73 F4 03 32 00 1C 24 41 00 04 22 41 00 01 00 00 00 08 60 03 00 -> CD F2 C8 41 E7 52
-    def NUL_String(self, hexdata: list[str]) -> list[str]:
-        for idx in range(len(hexdata)):
-            if hexdata[idx] == "00":
-                return hexdata[0:idx]
-        return hexdata
+    def NUL_String(self, data: bytes) -> bytes:
+        return bytes(data).split(b"\x00", 1)[0]
 
     # genre definition
     def get_genre_text(self, genre_num: int) -> str:
@@ -132,71 +179,85 @@ class OJNExtract():
         return genre_dict[genre_num]
        
     
-    def parse_ojn_header(self, filename):
+    # map the whole .ojn read-only, nothing is copied until a section is requested
+    # (the cover image alone is usually larger than all 3 diffs)
+    def open_ojn(self, filename):
+        self.close_ojn()
         ojn_filename = os.path.join(self.input_path, filename)
         with open(ojn_filename, "rb") as f:
-            hex_raw = f.read().hex()
-
-        self.hexdata = [hex_raw[i:i+2] for i in range(0, len(hex_raw), 2)]
-
-        self.song_id = int(self.LE(self.hexdata[0:4]), 16)
-        ojn_version_raw = self.SingleFloat(self.LE(self.hexdata[8:12]))
-        self.ojn_version = f"{ojn_version_raw:.2f}"
-        genre_num = int(self.LE(self.hexdata[12:16]), 16)
-        self.genre_text = self.get_genre_text(genre_num)
-        self.bpm = self.SingleFloat(self.LE(self.hexdata[16:20]))
-        self.lvl = [
-            int(self.LE(self.hexdata[20:22]), 16),
-            int(self.LE(self.hexdata[22:24]), 16),
-            int(self.LE(self.hexdata[24:26]), 16)
-        ]
-        self.total_notes = [
-            int(self.LE(self.hexdata[28:32]), 16),
-            int(self.LE(self.hexdata[32:36]), 16),
-            int(self.LE(self.hexdata[36:40]), 16)
-        ]
-        self.playable_notes = [
-            int(self.LE(self.hexdata[40:44]), 16),
-            int(self.LE(self.hexdata[44:48]), 16),
-            int(self.LE(self.hexdata[48:52]), 16)
-        ]
-        self.measure_count = [
-            int(self.LE(self.hexdata[52:56]), 16),
-            int(self.LE(self.hexdata[56:60]), 16),
-            int(self.LE(self.hexdata[60:64]), 16)
-        ]
-        self.package_count = [
-            int(self.LE(self.hexdata[64:68]), 16),
-            int(self.LE(self.hexdata[68:72]), 16),
-            int(self.LE(self.hexdata[72:76]), 16)
-        ]
-
-        self.title = bytes.fromhex(self.BE(self.NUL_String(self.hexdata[108:172]))).decode(self.enc).strip(" ").rstrip("\n")
-        self.artist = bytes.fromhex(self.BE(self.NUL_String(self.hexdata[172:204]))).decode(self.enc).strip(" ").rstrip("\n")
-        self.noter = bytes.fromhex(self.BE(self.NUL_String(self.hexdata[204:236]))).decode(self.enc).strip(" ").rstrip("\n")
-        self.ojm_name = bytes.fromhex(self.BE(self.NUL_String(self.hexdata[236:268]))).decode(self.enc).strip(" ")
+            self.ojn_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.ojn_view = memoryview(self.ojn_mmap)
+
+    # release the mapping of the current .ojn (slices taken from ojn_view should be released first)
+    # never raises, it's called from finally blocks and must not hide the original error
+    def close_ojn(self):
+        try:
+            if self.ojn_view is not None:
+                self.ojn_view.release()
+            if self.ojn_mmap is not None:
+                self.ojn_mmap.close()
+        except BufferError:
+            # a slice is still alive, the mapping is closed when the last reference goes away
+            print("[WARNING] a view into the .ojn wasn't released, it stays mapped until it's garbage collected")
+        self.ojn_view = None
+        self.ojn_mmap = None
 
-        self.cover_size = int(self.LE(self.hexdata[268:272]), 16)
-
-        self.duration = [
-            int(self.LE(self.hexdata[272:276]), 16),
-            int(self.LE(self.hexdata[276:280]), 16),
-            int(self.LE(self.hexdata[280:284]), 16)
-        ]
-
-        self.diff_offset = [
-            int(self.LE(self.hexdata[284:288]), 16),
-            int(self.LE(self.hexdata[288:292]), 16),
-            int(self.LE(self.hexdata[292:296]), 16)
-        ]
-        self.cover_offset = int(self.LE(self.hexdata[296:300]), 16)
+    def parse_ojn_header(self, filename):
+        self.open_ojn(filename)
+        try:
+            self.decode_ojn_header(self.ojn_view, encoding_lib.get_server(filename))
+        except Exception:
+            # don't keep the file mapped (e.g. export_csv moves undecodable files away)
+            self.close_ojn()
+            raise
+
+    # read only the header of an .ojn (the charts and cover image are not touched)
+    def read_ojn_header(self, filename) -> bytes:
+        with open(os.path.join(self.input_path, filename), "rb") as f:
+            return f.read(300)
+
+    # header layout (300 bytes, little-endian)
+    # https://open2jam.wordpress.com/the-ojn-documentation/
+    # returns the header fields as a dict, self is not modified (safe to call from several threads)
+    # enc -> codec of the text fields, "auto" = encoding_lib.detect_encoding (server -> encoding_lib.get_server of the ojn)
+    def unpack_ojn_header(self, header, enc, server="") -> dict:
+        if enc == "auto":
+            fields = [self.NUL_String(header[start:end]) for start, end in [(108, 172), (172, 204), (204, 236), (236, 268)]]
+            # nothing decodes -> let the first candidate raise UnicodeDecodeError
+            enc = encoding_lib.detect_encoding(fields, server) or encoding_lib.CANDIDATES[0]
+        ojn_version_raw, genre_num, bpm = struct.unpack_from("<fIf", header, 8)
+        diff_offset = list(struct.unpack_from("<3I", header, 284))
+        cover_offset, = struct.unpack_from("<I", header, 296)
+        return {
+            "song_id": struct.unpack_from("<I", header, 0)[0],
+            "ojn_version": f"{ojn_version_raw:.2f}",
+            "genre_text": self.get_genre_text(genre_num),
+            "bpm": bpm,
+            "lvl": list(struct.unpack_from("<3H", header, 20)),
+            "total_notes": list(struct.unpack_from("<3I", header, 28)),
+            "playable_notes": list(struct.unpack_from("<3I", header, 40)),
+            "measure_count": list(struct.unpack_from("<3I", header, 52)),
+            "package_count": list(struct.unpack_from("<3I", header, 64)),
+            "title": self.NUL_String(header[108:172]).decode(enc).strip(" ").rstrip("\n"),
+            "artist": self.NUL_String(header[172:204]).decode(enc).strip(" ").rstrip("\n"),
+            "noter": self.NUL_String(header[204:236]).decode(enc).strip(" ").rstrip("\n"),
+            "ojm_name": self.NUL_String(header[236:268]).decode(enc).strip(" "),
+            "text_enc": enc, # codec actually used for the text fields
+            "cover_size": struct.unpack_from("<I", header, 268)[0],
+            "duration": list(struct.unpack_from("<3I", header, 272)),
+            "diff_offset": diff_offset,
+            "cover_offset": cover_offset,
+            # used for parsing notes
+            "diff_size": [
+                diff_offset[1] - diff_offset[0],
+                diff_offset[2] - diff_offset[1],
+                cover_offset - diff_offset[2],
+            ]
+        }
 
-        # used for parsing notes
-        self.diff_size = [
-            self.diff_offset[1] - self.diff_offset[0],
-            self.diff_offset[2] - self.diff_offset[1],
-            self.cover_offset - self.diff_offset[2],
-        ]
+    def decode_ojn_header(self, header, server=""):
+        for name, value in self.unpack_ojn_header(header, self.enc, server).items():
+            setattr(self, name, value)
 
         # skip duplicate chart (with same diff size)
         # Sometimes diff_size are the same but playable notes are different (o2ma392 - God Knows Piano Ver by Doaz)
@@ -221,7 +282,7 @@ class OJNExtract():
 
     # parse jpeg background image
     def parse_image(self):
-        self.image_raw = bytes.fromhex(self.BE(self.hexdata[self.cover_offset:self.cover_offset + self.cover_size]))
+        self.image_raw = bytes(self.ojn_view[self.cover_offset:self.cover_offset + self.cover_size])
 
 
     # parse all 3 diffs
@@ -239,29 +300,30 @@ class OJNExtract():
         8        note on 7th lane
         9~22     auto-play samples(?)
         '''
+        # read-only record arrays for each diff (see note_dtype, timing_dtype, frac_measure_dtype, autoplay_dtype)
         self.diff_notes = {
-            0: [],
-            1: [],
-            2: []
+            0: np.zeros(0, dtype=self.note_dtype),
+            1: np.zeros(0, dtype=self.note_dtype),
+            2: np.zeros(0, dtype=self.note_dtype)
         }
         
         self.diff_timings = {
-            0: [],
-            1: [],
-            2: []
+            0: np.zeros(0, dtype=self.timing_dtype),
+            1: np.zeros(0, dtype=self.timing_dtype),
+            2: np.zeros(0, dtype=self.timing_dtype)
         }
 
         # This is for channel == 0
         self.diff_frac_measure = {
-            0: [],
-            1: [],
-            2: []
+            0: np.zeros(0, dtype=self.frac_measure_dtype),
+            1: np.zeros(0, dtype=self.frac_measure_dtype),
+            2: np.zeros(0, dtype=self.frac_measure_dtype)
         }
 
         self.diff_autoplay_samples = {
-            0: [],
-            1: [],
-            2: []
+            0: np.zeros(0, dtype=self.autoplay_dtype),
+            1: np.zeros(0, dtype=self.autoplay_dtype),
+            2: np.zeros(0, dtype=self.autoplay_dtype)
         }
         
         for diff_idx in range(len(self.diff_size)):
@@ -269,211 +331,162 @@ class OJNExtract():
             if self.skip_diff[diff_idx]:
                 continue
             
-            # get current diff hexdata
+            # decode all packages of current diff section (a view into the mapped .ojn)
             diff_start = self.diff_offset[diff_idx]
             diff_end = diff_start + self.diff_size[diff_idx]
-            diff_raw = self.hexdata[diff_start:diff_end]
             self.curr_diff = f"{self.diff_scale[diff_idx]} (lvl {self.lvl[diff_idx]})"
-
-            pos = 0
-
+            # the slice is released even if decoding fails, otherwise close_ojn() can't close the mapping
+            with self.ojn_view[diff_start:diff_end] as diff_raw:
+                packages, events = self.decode_packages(diff_raw, self.package_count[diff_idx])
+                # try to get divisor of the song (might not be reliable)
+                # reads the events field of the first package_count 8 bytes words of the block, without skipping the events of a package
+                # (not the real packages, but that's how the divisor has always been guessed, so the offsets of converted charts don't change)
+                divisor_events = np.ndarray((self.package_count[diff_idx],), dtype="<u2", buffer=diff_raw, offset=6, strides=(8,)).astype(np.int64)
+
+            # the first one with events != 1 that is a multiple of 4 (or 3)
+            divisor_guess = (divisor_events != 1) & ((divisor_events % 4 == 0) | (divisor_events % 3 == 0))
+            if divisor_guess.any():
+                self.divisor = 4 if divisor_events[np.argmax(divisor_guess)] % 4 == 0 else 3
+
+            channel = events["channel"]
+            sample_value = events["sample_value"]
+            note_type = events["note_type"]
+
+            # When the channel is 0 (fractional measure), the 4 bytes are a float, indicating how much of the measure is actually used, so if the value is 0.75, the size of this measure will be only 75% of a normal measure.
+            # Looks like note's measure_start will not exceed frac_measure (e.g. frac_measure = 0.5, note measure = .125, .25, .375, .4375)
+            frac_packages = packages["channel"] == 0
+            frac_measure = self.make_records(self.frac_measure_dtype, {
+                "measure": packages["measure"][frac_packages],
+                "frac": packages["float"][frac_packages]
+            })
+
+            # When the channel is 1 (BPM change) these 4 bytes are a float with the new BPM.
             # Initial BPM
-            timings = [[self.bpm, 0]]
-
-            # dicts in list: type, lane, sample_value, sample_volume, sample_pan, measure_start, measure_end (if ln)
-            # type -> 0 = rice; 1 = ln
-            # lane -> 0-6 (channel - 2)
-            notes = []
-
-            # long notes pairing list (temporary, paired ln will then be moved to notes)
-            ln_notes = []
-
-            # autoplay samples [sample_no, sample_volume, measure]
-            # sample_volume -> 0-15, 0 = maximum
-            autoplay_samples = []
-
-            # channel 0 fraction measure [measure, frac]
-            frac_measure = []
-
-            # try to get divisor of the song (might not be reliable)
-            temp_pos = 0
-            for package_idx in range(self.package_count[diff_idx]):
-                events = int(self.LE(diff_raw[temp_pos+6:temp_pos+8]), 16)
-                temp_pos += 8
-
-                if events == 1:
+            bpm_events = (channel == 1) & (events["float"] != 0)
+            timings = [[self.bpm, 0]] + [list(t) for t in zip(events["float"][bpm_events].tolist(), events["measure"][bpm_events].tolist())]
+
+            # When channel > 1, these 4 bytes are divided like this:
+            # short16 sample_value; (2 bytes)
+            # half-char sample_volume; (0.5 byte) -> 0-15, 0 is maximum
+            # half-char pan; (0.5 byte) -> 1~7 = left -> center, 0 or 8 = center, 9~15 = center -> right
+            # char note_type; (1 byte)
+            # sample_value 0 -> ignored; other -> sample in ojm
+
+            # channel is 2-8 (playable notes)
+            # note_type = 4 -> normal note & use ogg sample
+            note_events = (channel >= 2) & (channel <= 8) & (sample_value != 0)
+            ogg_notes = note_events & (note_type == 4)
+            note_sample_value = np.where(ogg_notes, sample_value + 1000, sample_value)
+            rice_idx = np.flatnonzero(note_events & ((note_type == 0) | ogg_notes))
+
+            # long notes pairing, ln heads of each lane sorted by measure_start (paired ln will then be moved to notes)
+            # ln head = [event_idx, measure_start]
+            ln_heads = [collections.deque() for _ in range(7)]
+            ln_head_idx = []
+            ln_tail_idx = [] # the order of a paired ln in notes follows its tail
+            ln_measure_end = []
+            unpaired_heads = 0
+            unpaired_tails = 0
+            ln_idx = np.flatnonzero(note_events & ((note_type == 2) | (note_type == 3)))
+            for event_idx, lane, ln_type, measure in zip(ln_idx.tolist(), (channel[ln_idx] - 2).tolist(), note_type[ln_idx].tolist(), events["measure"][ln_idx].tolist()):
+                lane_heads = ln_heads[lane]
+
+                # ln start (put it in ln_heads for pairing)
+                if ln_type == 2:
+                    if len(lane_heads) == 0 or lane_heads[-1][1] <= measure:
+                        lane_heads.append([event_idx, measure])
+                    else:
+                        # packages are usually sorted by measure, so this is rare
+                        idx = len(lane_heads)
+                        while idx > 0 and lane_heads[idx - 1][1] > measure:
+                            idx -= 1
+                        lane_heads.insert(idx, [event_idx, measure])
                     continue
 
-                if events % 4 == 0:
-                    self.divisor = 4
-                    break
-                if events % 3 == 0:
-                    self.divisor = 3
-                    break
-
-            # get notes for each diff
-            for package_idx in range(self.package_count[diff_idx]):
-                # read package header
-                _debug_package_header = diff_raw[pos:pos+8]
-                measure = int(self.LE(diff_raw[pos:pos+4]), 16)
-                channel = int(self.LE(diff_raw[pos+4:pos+6]), 16)
-                events = int(self.LE(diff_raw[pos+6:pos+8]), 16)
-                pos += 8
-
-                _debug_package_content = diff_raw[pos:pos+events*4]
-                
-
-                # When the channel is 0 (fractional measure), the 4 bytes are a float, indicating how much of the measure is actually used, so if the value is 0.75, the size of this measure will be only 75% of a normal measure.
-                # Looks like note's measure_start will not exceed frac_measure (e.g. frac_measure = 0.5, note measure = .125, .25, .375, .4375)
-                if channel == 0:
-                    frac = self.SingleFloat(self.LE(diff_raw[pos:pos+4]))
-                    frac_measure.append([measure, frac])
-                    #self.error_log(f"channel == 0, not implemented! frac = {frac_measure}, measure = {measure}")
-
-                # When the channel is 1 (BPM change) these 4 bytes are a float with the new BPM.
-                elif channel == 1:
-                    for i in range(events):
-                        new_bpm = self.SingleFloat(self.LE(diff_raw[pos+4*i:pos+4*(i+1)]))
-                        if new_bpm == 0:
-                            continue
-                        timings.append([new_bpm, measure + i / events])
-
-                # When channel > 1, these 4 bytes are divided like this:
-                # short16 sample_value; (2 bytes)
-                # half-char sample_volume; (0.5 byte)
-                # half-char pan; (0.5 byte)
-                # char note_type; (1 byte)
-
-                # channel is 2-8 (playable notes)
-                elif 2 <= channel <= 8:
-                    for i in range(events):
-                        # 0 -> ignored; other -> sample in ojm
-                        sample_value = int(self.LE(diff_raw[pos+4*i:pos+4*i+2]), 16)
-                        if sample_value == 0:
-                            continue
-
-                        # sample volume (0-15), 0 is maximum
-                        sample_volume = int(diff_raw[pos+4*i+2][0], 16)
-                        
-                        # 1~7 = left -> center, 0 or 8 = center, 9~15 = center -> right
-                        sample_pan = int(diff_raw[pos+4*i+2][1], 16)
-                        note_type = int(self.LE([diff_raw[pos+4*i+3]]), 16)
-
-                        # note_type = 4 -> normal note & use ogg sample
-                        if note_type == 4:
-                            note_type = 0
-                            sample_value += 1000
-                        
-                        # rice
-                        if note_type == 0:
-                            notes.append({
-                                "type": 0,
-                                "lane": channel - 2,
-                                "sample_value": sample_value,
-                                "sample_volume": sample_volume,
-                                "sample_pan": sample_pan,
-                                "measure_start": measure + i / events
-                            })
-                        
-                        # ln start (put it in ln_notes for pairing)
-                        elif note_type == 2:
-                            ln_notes.append({
-                                "type": 1,
-                                "lane": channel - 2,
-                                "sample_value": sample_value,
-                                "sample_volume": sample_volume,
-                                "sample_pan": sample_pan,
-                                "measure_start": measure + i / events
-                            })
-                        
-                        # ln end (pair with ln start in ln_notes)
-                        elif note_type == 3:
-                            # find "ln start" in ln_notes with same channel
-                            lane = channel - 2
-                            measure_end = measure + i / events
-                            match = [] # [idx, measure_start]
-                            for idx in range(len(ln_notes)):
-                                if lane == ln_notes[idx]["lane"]:
-                                    match.append([idx, ln_notes[idx]["measure_start"]])
-                            match.sort(key=lambda x: x[1], reverse=True) # higher measure comes first
-                            
-                            flag_paired = False
-
-                            # pairing algorithm (always go for the longest possible ln, and remove all the extra ln heads between them)
-                            # Following examples: H1 = ln head #1, T1 = ln tail #1
-                            # Note: ln head always comes before ln tail in ojn raw data
-                            # e.g. H1 H2 T1 -> (H1 T1), remove H2 because it's invalid ln head (If we pair H2 with T1, then there should be a T0 that comes before T1 to pair with H1, like H1 T0 H2 T1)
-                            # e.g. H1 T1 H2 -> (H1 T1), keep H2 because there might be a T2 coming to pair with H2
-                            if len(match) > 0:
-                                if measure_end > match[-1][1]:
-                                    ln_notes[match[-1][0]]["measure_end"] = measure_end
-                                    notes.append(ln_notes[match[-1][0]])
-                                    for idx in range(len(match)):
-                                        if measure_end > match[idx][1]:
-                                            ln_notes.pop(match[idx][0])
-                                    flag_paired = True
-
-                            # if there's no ln head to pair with, we can consider the ln tail invalid and safely drop it
-                            if not flag_paired:
-                                self.warning_log(f"Failed to pair ln notes! Usually this warning can be ignored.")
-                                if self.debug:
-                                    ln_tail_info = {
-                                    "package_idx": package_idx,
-                                    "measure": measure,
-                                    "lane": lane,
-                                    "measure_end": measure_end,
-                                    }
-                                    print(f"ln_tail_info = {ln_tail_info}")
-                                    print(f"match = {match}")
-                                    print(f"ln_notes = {ln_notes}")
-                
-                # channel is 9-22 (autoplay notes)
-                # As far as I know these are usually 9-15
+                # ln end (pair with ln start in ln_heads)
+                # pairing algorithm (always go for the longest possible ln, and remove all the extra ln heads between them)
+                # Following examples: H1 = ln head #1, T1 = ln tail #1
+                # Note: ln head always comes before ln tail in ojn raw data
+                # e.g. H1 H2 T1 -> (H1 T1), remove H2 because it's invalid ln head (If we pair H2 with T1, then there should be a T0 that comes before T1 to pair with H1, like H1 T0 H2 T1)
+                # e.g. H1 T1 H2 -> (H1 T1), keep H2 because there might be a T2 coming to pair with H2
+                # if heads share the earliest measure_start, the last one read wins
+                if len(lane_heads) > 0 and lane_heads[0][1] < measure:
+                    ln_head = lane_heads.popleft()
+                    while len(lane_heads) > 0 and lane_heads[0][1] < measure:
+                        if lane_heads[0][1] == ln_head[1]:
+                            ln_head = lane_heads.popleft()
+                        else:
+                            lane_heads.popleft()
+                        unpaired_heads += 1
+                    ln_head_idx.append(ln_head[0])
+                    ln_tail_idx.append(event_idx)
+                    ln_measure_end.append(measure)
+
+                # if there's no ln head to pair with, we can consider the ln tail invalid and safely drop it
                 else:
-                    for i in range(events):
-                        note_type = int(self.LE([diff_raw[pos+4*i+3]]), 16)
-
-                        sample_value = int(self.LE(diff_raw[pos+4*i:pos+4*i+2]), 16)
-                        
-                        # always ignore the event when sample_value is 0
-                        if sample_value == 0:
-                            continue
-
-                        # note_type = 4 -> ogg sample (sample_value > 1000)
-                        # note_type = 0 -> ogg/wav sample (sample_value < 1000)
-                        if note_type == 4:
-                            sample_value += 1000
-                        elif note_type != 0:
-                            #self.warning_log(f"Unrecognized autoplay sample note_type: {diff_raw[pos+4*i:pos+4*i+4]}, events # = {events}, channel # = {channel}, note_type = {note_type}")
-                            continue
-                        
-                        # to match the OJM sample value
-                        sample_value += 1
-
-                        # ignore the event if there's no actual hitsound file extracted from OJM to play
-                        if sample_value not in self.ojm.sound_dict:
-                            continue
-                        
-                        sample_volume = int(diff_raw[pos+4*i+2][0], 16)
-                        autoplay_samples.append([sample_value, sample_volume, measure + i / events])
-                        if self.debug:
-                            print(f"{diff_raw[pos+4*i:pos+4*i+4]}, channel = {channel}")
-                            print(f"autoplay_sample = {[sample_value, sample_volume, measure + i / events]}")
-
-                pos += events * 4
-            
-            if len(ln_notes) > 0:
-                self.warning_log(f"ln_notes = {ln_notes}")
-            
-            notes.sort(key=lambda x: x["measure_start"])
+                    unpaired_tails += 1
+                    if self.debug:
+                        ln_tail_info = {
+                        "package_idx": int(events["package"][event_idx]),
+                        "measure": int(packages["measure"][events["package"][event_idx]]),
+                        "lane": lane,
+                        "measure_end": measure,
+                        }
+                        print(f"ln_tail_info = {ln_tail_info}")
+                        print(f"ln_heads = {list(lane_heads)}")
+
+            unpaired_heads += sum(len(lane_heads) for lane_heads in ln_heads)
+            if unpaired_heads > 0 or unpaired_tails > 0:
+                self.warning_log(f"Failed to pair ln notes! {unpaired_heads} ln heads and {unpaired_tails} ln tails dropped. Usually this warning can be ignored.")
+
+            # sorted by measure_start, then by the position of the note (ln tail for ln) in the ojn
+            note_idx = np.concatenate([rice_idx, np.array(ln_head_idx, dtype=np.int64)])
+            note_seq = np.concatenate([rice_idx, np.array(ln_tail_idx, dtype=np.int64)])
+            note_is_ln = np.arange(len(note_idx)) >= len(rice_idx)
+            note_measure_end = np.concatenate([np.full(len(rice_idx), np.nan), np.array(ln_measure_end, dtype=np.float64)])
+            note_order = np.lexsort((note_seq, events["measure"][note_idx]))
+            note_idx = note_idx[note_order]
+            notes = self.make_records(self.note_dtype, {
+                "type": note_is_ln[note_order],
+                "lane": channel[note_idx] - 2,
+                "sample_value": note_sample_value[note_idx],
+                "sample_volume": events["volume"][note_idx],
+                "sample_pan": events["pan"][note_idx],
+                "measure_start": events["measure"][note_idx],
+                "measure_end": note_measure_end[note_order]
+            })
+
+            # channel is 9-22 (autoplay notes)
+            # As far as I know these are usually 9-15
+            # note_type = 4 -> ogg sample (sample_value > 1000)
+            # note_type = 0 -> ogg/wav sample (sample_value < 1000)
+            # +1 to match the OJM sample value
+            autoplay_events = (channel >= 9) & (sample_value != 0) & ((note_type == 0) | (note_type == 4))
+            autoplay_sample_value = np.where(note_type == 4, sample_value + 1000, sample_value) + 1
+
+            # ignore the event if there's no actual hitsound file extracted from OJM to play
+            autoplay_events &= np.isin(autoplay_sample_value, np.array(list(self.ojm.sound_dict), dtype=np.int64))
+
+            autoplay_samples = self.make_records(self.autoplay_dtype, {
+                "sample_id": autoplay_sample_value[autoplay_events],
+                "sample_volume": events["volume"][autoplay_events],
+                "measure": events["measure"][autoplay_events]
+            })
+            if self.debug:
+                for event_idx, ogg in zip(np.flatnonzero(autoplay_events).tolist(), autoplay_samples.tolist()):
+                    print(f"{struct.pack('<HBB', sample_value[event_idx], events['volume'][event_idx] << 4 | events['pan'][event_idx], note_type[event_idx]).hex()}, channel = {channel[event_idx]}")
+                    print(f"autoplay_sample = {list(ogg)}")
+
             self.diff_notes[diff_idx] = notes
             self.diff_frac_measure[diff_idx] = frac_measure
+            profile_lib.profiler.count("notes", len(notes))
+            profile_lib.profiler.count("lns", len(ln_head_idx))
             
             # insert timing point with same bpm right after the fractional measure
             timings = self.clean_timings(timings)
-            for f_idx in range(len(frac_measure)):
+            for frac_measure_start in frac_measure["measure"].tolist():
                 for t_idx in range(len(timings)):
-                    target_measure = frac_measure[f_idx][0] + 1
+                    target_measure = frac_measure_start + 1
                     if timings[t_idx][1] == target_measure:
                         break
                     elif timings[t_idx][1] > target_measure:
@@ -481,10 +494,116 @@ class OJNExtract():
                         break
             
             timings.sort(key=lambda x: x[1])
-            self.diff_timings[diff_idx] = timings
+            self.diff_timings[diff_idx] = self.make_records(self.timing_dtype, {
+                "bpm": [t[0] for t in timings],
+                "measure": [t[1] for t in timings]
+            })
             self.diff_autoplay_samples[diff_idx] = autoplay_samples
             
-        
+
+    # build a read-only record array from columns {field name: values}
+    def make_records(self, dtype, columns):
+        records = np.zeros(len(columns[dtype.names[0]]), dtype=dtype)
+        for name in dtype.names:
+            records[name] = columns[name]
+        records.flags.writeable = False
+        return records
+
+    # decode the packages of a diff section in bulk
+    # package = header (int32 measure, short16 channel, short16 events) + events * 4 bytes, so everything is 4 bytes aligned
+    # returns (packages, events), dicts of numpy arrays in ojn order
+    # packages -> measure, channel, events, float (first event read as float, for channel 0)
+    # events -> package, channel, measure, sample_value, volume, pan, note_type, float (for channel 0 and 1)
+    def decode_packages(self, diff_raw, package_count):
+        word_count = len(diff_raw) // 4
+        header_words = np.ndarray((max(word_count - 1, 0),), dtype=self.package_header_dtype, buffer=diff_raw, strides=(4,))
+        event_words = np.frombuffer(diff_raw, dtype=self.package_event_dtype, count=word_count)
+        float_words = np.frombuffer(diff_raw, dtype="<f4", count=word_count)
+
+        # walk through the package headers (a package is 2 + events words)
+        events_at_word = header_words["events"].tolist()
+        package_words = []
+        word = 0
+        for package_idx in range(package_count):
+            package_words.append(word)
+            word += 2 + events_at_word[word]
+        package_words = np.array(package_words, dtype=np.int64)
+
+        headers = header_words[package_words]
+        package_measure = headers["measure"].astype(np.int64)
+        package_events = headers["events"].astype(np.int64)
+        package_channel = headers["channel"].astype(np.int64)
+
+        # only channel 0 packages have a float (the fraction of the measure, right after the header)
+        package_float = np.zeros(package_count, dtype=np.float64)
+        float_packages = (package_channel == 0) & (package_words + 2 < word_count)
+        package_float[float_packages] = float_words[package_words[float_packages] + 2]
+
+        packages = {
+            "measure": package_measure,
+            "channel": package_channel,
+            "events": package_events,
+            "float": package_float
+        }
+
+        # event i of a package is at word (package word + 2 + i), measure = measure + i / events
+        event_package = np.repeat(np.arange(package_count), package_events)
+        event_i = np.arange(len(event_package)) - np.repeat(np.cumsum(package_events) - package_events, package_events)
+        event_word = np.repeat(package_words + 2, package_events) + event_i
+        event_data = event_words[event_word]
+        events = {
+            "package": event_package,
+            "channel": package_channel[event_package],
+            "measure": package_measure[event_package] + event_i / package_events[event_package],
+            "sample_value": event_data["sample_value"].astype(np.int64),
+            "volume": (event_data["volume_pan"] >> 4).astype(np.int64),
+            "pan": (event_data["volume_pan"] & 0x0F).astype(np.int64),
+            "note_type": event_data["note_type"].astype(np.int64),
+            "float": float_words[event_word].astype(np.float64)
+        }
+        return packages, events
+
+    # measure -> offset lookup table of a diff (timings sorted by measure, offsets of each timing point)
+    def get_timing_map(self, timings, offsets):
+        measure = timings["measure"]
+        return {
+            "measure": measure,
+            "first": np.searchsorted(measure, measure, side="left"), # same measure appears twice -> the first timing point wins
+            "offset": np.array(offsets, dtype=np.float64),
+            "ms_per_measure": 60000 / timings["bpm"] * self.divisor # uncapped bpm, same as the chart
+        }
+
+    # convert measure(s) to offset (ms), a list of measures is converted in one go
+    def measure_to_offset(self, timing_map, measures):
+        measures_arr = np.asarray(measures, dtype=np.float64)
+        t_idx = np.searchsorted(timing_map["measure"], measures_arr, side="right") - 1
+        t_idx = timing_map["first"][np.maximum(t_idx, 0)]
+        offsets = timing_map["offset"][t_idx] + (measures_arr - timing_map["measure"][t_idx]) * timing_map["ms_per_measure"][t_idx]
+        return np.floor(offsets).astype(np.int64).tolist()
+
+    # [HitObjects] section of a diff, lines are generated while the .osu is written
+    def get_osu_hitobjects(self, notes, offsets, offsets_end, hitsounds):
+        osu_col_coord = np.array([math.floor((512 / 7) * (i + 0.5)) for i in range(7)])
+        yield "[HitObjects]"
+        for x, note_type, offset, offset_end, hitsound in zip(osu_col_coord[notes["lane"]].tolist(), notes["type"].tolist(), offsets, offsets_end, hitsounds):
+            if note_type == 0:
+                res_str = "1,0,0:0:0"
+            else: # ln needs offset_end
+                res_str = f"128,0,{offset_end}:0:0:0"
+
+            if hitsound is None or self.flag_use_mp3:
+                yield f"{x},0,{offset},{res_str}:0:"
+            else:
+                yield f"{x},0,{offset},{res_str}:100:{hitsound}"
+
+    # write .osu sections (lists or generators of lines) to a text stream (file, io.StringIO, zip entry...)
+    def write_osu(self, f, sections):
+        f.write("osu file format v14\n\n")
+        for idx in range(len(sections)):
+            f.writelines(line + "\n" for line in sections[idx])
+            if idx != len(sections) - 1:
+                f.write("\n\n")
+
     # generate .osu, .jpg, .mp3
     def export_osu(self):
         # generate .osu
@@ -494,9 +613,11 @@ class OJNExtract():
             [2, 5]
         ]
 
-        mp3_dict = {} # {duration: output_filename}
-        audio_filename = "virtual"
-        preview_time = "1234"
+        mp3_dict = {} # {remix list fingerprint: output_filename}, diffs with the same mix share one mp3
+        sound_keys = {} # {sound_filename: audio_lib.get_sound_key()}, see get_remix_fingerprint
+        self.audio_info = {} # {output_filename: audio_lib.get_audio_info()}
+        render_jobs = [] # [[output_filename, remix_list]], rendered after every diff is ready
+        osu_diffs = [] # [[osu_filename, audio_filename, sections]], written once the mp3 are rendered
         
         for diff_idx in range(len(self.diff_size)):
             # skip if duplicate
@@ -516,59 +637,50 @@ class OJNExtract():
             
             
             # Calculate timing points (convert o2jam measure to osu offset)
+            timings = self.diff_timings[diff_idx]
+            timing_offsets = []
+            timing_ms_per_measure = []
             ms_previous_bpm = 60000 / self.bpm * self.divisor
+
+            # fractional measures sorted by critical measure (measure + frac), so each timing point only sums its own range
+            frac_measure = self.diff_frac_measure[diff_idx]
+            critical_measures = frac_measure["measure"] + frac_measure["frac"]
+            frac_order = np.argsort(critical_measures, kind="stable")
+            critical_measures = critical_measures[frac_order].tolist()
+            frac_skipped = (1 - frac_measure["frac"][frac_order]).tolist()
             
-            for t_idx in range(len(self.diff_timings[diff_idx])):
-                t: list = self.diff_timings[diff_idx][t_idx] # t = [bpm, measure]
-                current_bpm = t[0]
-                current_measure = t[1]
-                
+            for t_idx, (current_bpm, current_measure) in enumerate(zip(timings["bpm"].tolist(), timings["measure"].tolist())):
                 ms_per_measure = 60000 / current_bpm
 
                 if ms_per_measure < 1:
                     ms_per_measure = 1
                     current_bpm = 60000
                 
-                frac_delta = 0
-                
                 if t_idx == 0:
                     offset = round(current_measure * ms_previous_bpm) # this starting offset should be 0 most of the time
                 else:
                     # calculate fractional measure
-                    for f_idx in range(len(self.diff_frac_measure[diff_idx])):
-                        critical_measure = sum(self.diff_frac_measure[diff_idx][f_idx])
-                        if previous_measure <= critical_measure < current_measure:
-                            frac_delta += 1 - self.diff_frac_measure[diff_idx][f_idx][1]
+                    frac_start = bisect.bisect_left(critical_measures, previous_measure)
+                    frac_end = bisect.bisect_left(critical_measures, current_measure)
+                    frac_delta = sum(frac_skipped[frac_start:frac_end])
                     offset = round(previous_offset + ms_previous_bpm * (current_measure - previous_measure - frac_delta))
-                t.extend([offset, ms_per_measure]) # t = [bpm, measure, offset, ms_per_measure]
+                timing_offsets.append(offset)
+                timing_ms_per_measure.append(ms_per_measure)
                 ms_previous_bpm = 60000 / current_bpm * self.divisor
                 previous_offset = offset
                 previous_measure = current_measure
 
-            curr_diff_timings = copy.deepcopy(self.diff_timings[diff_idx])
-
-            curr_diff_timings.sort(key=lambda x: x[1], reverse=True) # sort by measure (reverse order)
-            
-            def get_note_offset(measure_val):
-                offset = 0
-                for t_idx in range(len(curr_diff_timings)):
-                    if measure_val >= curr_diff_timings[t_idx][1]:
-                        measure_delta = measure_val - curr_diff_timings[t_idx][1]
-                        offset_delta = measure_delta * (60000 / curr_diff_timings[t_idx][0] * self.divisor)
-                        offset = curr_diff_timings[t_idx][2] + offset_delta
-                        return math.floor(offset)
+            timing_map = self.get_timing_map(timings, timing_offsets)
 
 
             # [Event] Calculate autoplay ogg samples offset here
             ogg_volumes = [math.floor(x * 100 / 15) for x in range(16)]
             ogg_volumes.sort(reverse=True)
 
-            for ogg in self.diff_autoplay_samples[diff_idx]:
-                # ogg = [sample_id, sample_volume, measure]
-                sample_id = ogg[0]
-                measure = ogg[2]
-                ext = self.ojm.sound_dict[sample_id] # already filtered in parse_diff(), so we can safely read from sound_dict
-                ogg.extend([get_note_offset(measure), ext]) # ogg = [sample_id, sample_volume, measure, offset, ext]
+            autoplay = self.diff_autoplay_samples[diff_idx]
+            notes = self.diff_notes[diff_idx]
+            autoplay_offsets = self.measure_to_offset(timing_map, autoplay["measure"])
+            autoplay_ext = [self.ojm.sound_dict[sample_id] for sample_id in autoplay["sample_id"].tolist()] # already filtered in parse_diff(), so we can safely read from sound_dict
             
             
             mp3_offset = 0 # If flag_use_mp3 == True, this will be a negative number
@@ -579,39 +691,32 @@ class OJNExtract():
             # if convert mp3, need to shift the whole chart because autoplay event doesn't start at 0ms
             if self.flag_use_mp3:
                 # Get the first autoplay event offset
-                for ogg in self.diff_autoplay_samples[diff_idx]:
-                    # ogg = [sample_id, sample_volume, measure, offset, ext]
-                    first_autoplay_ms = ogg[3]
-                    break
+                if len(autoplay) > 0:
+                    first_autoplay_ms = autoplay_offsets[0]
 
                 # Get the first note offset
-                for note in self.diff_notes[diff_idx]:
-                    first_note_ms = get_note_offset(note["measure_start"])
-                    break
+                if len(notes) > 0:
+                    first_note_ms = self.measure_to_offset(timing_map, notes["measure_start"][0])
 
                 if first_autoplay_ms < first_note_ms:
                     mp3_offset = -first_autoplay_ms
 
                 
                 # prevent negative ms notes
-                if ogg[2] < self.diff_notes[diff_idx][0]['measure_start']:
+                if len(autoplay) > 0 and autoplay["measure"][0] < notes["measure_start"][0]:
                     mp3_offset += self.extra_offset
                     
 
-                # Shift curr_diff_timings by mp3_offset
-                for t in curr_diff_timings:
-                    t[2] += mp3_offset
-                for t in self.diff_timings[diff_idx]:
-                    t[2] += mp3_offset
+                # Shift timing_map by mp3_offset
+                timing_map["offset"] = timing_map["offset"] + mp3_offset
+                timing_offsets = [offset + mp3_offset for offset in timing_offsets]
 
                 # Shift all events by mp3_offset
-                for ogg in self.diff_autoplay_samples[diff_idx]:
-                    ogg[3] += mp3_offset
+                autoplay_offsets = [offset + mp3_offset for offset in autoplay_offsets]
+                for sample_id, offset, ext in zip(autoplay["sample_id"].tolist(), autoplay_offsets, autoplay_ext):
                     # minus self.extra_offset here because extra offset should only apply to chart, not the song
-                    curr_mp3_remix_list.append([ogg[3] - self.extra_offset, f"normal-hitnormal{ogg[0]}.{ogg[4]}"])
-
+                    curr_mp3_remix_list.append([offset - self.extra_offset, f"normal-hitnormal{sample_id}.{ext}"])
 
-            osu_file = "osu file format v14\n\n"
 
             osu_editor = [
                 "[Editor]",
@@ -661,19 +766,16 @@ class OJNExtract():
             if self.flag_use_mp3:
                 pass
             else:
-                for ogg in self.diff_autoplay_samples[diff_idx]:
-                    sample_id = ogg[0]
-                    sample_volume = ogg[1]
-                    offset = ogg[3]
-                    ext = ogg[4]
+                for sample_id, sample_volume, offset, ext in zip(autoplay["sample_id"].tolist(), autoplay["sample_volume"].tolist(), autoplay_offsets, autoplay_ext):
                     osu_events.append(f"5,{offset},0,\"normal-hitnormal{sample_id}.{ext}\",{ogg_volumes[sample_volume]}")
 
             osu_timing_points = ["[TimingPoints]"]
+            osu_timings = [list(t) for t in zip(timings["bpm"].tolist(), timings["measure"].tolist(), timing_offsets, timing_ms_per_measure)] # t = [bpm, measure, offset, ms_per_measure]
 
             # find correct starting offset when using mp3
             if self.flag_use_mp3:
-                first_note_measure = self.diff_notes[diff_idx][0]['measure_start']
-                timing_measure_lst = [t[1] for t in self.diff_timings[diff_idx]]
+                first_note_measure = notes["measure_start"][0]
+                timing_measure_lst = timings["measure"].tolist()
                 new_start_measure = float(math.floor(first_note_measure))
                 try:
                     index = timing_measure_lst.index(new_start_measure)
@@ -685,28 +787,27 @@ class OJNExtract():
                 if index >= 0:
                     timing_remove = list(reversed(range(index)))
                     for i in timing_remove:
-                        self.diff_timings[diff_idx].pop(i)
+                        osu_timings.pop(i)
                 else:
                     if len(timing_measure_lst) == 1:
-                        self.diff_timings[diff_idx][0][1] = new_start_measure
-                        self.diff_timings[diff_idx][0][2] = get_note_offset(new_start_measure)
+                        osu_timings[0][1] = new_start_measure
+                        osu_timings[0][2] = self.measure_to_offset(timing_map, new_start_measure)
                     else:
                         for m_idx in range(len(timing_measure_lst)):
                             if timing_measure_lst[m_idx] > new_start_measure:
                                 timing_remove = list(reversed(range(m_idx)))
-                                bpm = self.diff_timings[diff_idx][m_idx - 1][0]
-                                offset = get_note_offset(new_start_measure)
-                                ms_per_measure = self.diff_timings[diff_idx][m_idx - 1][3]
+                                bpm = osu_timings[m_idx - 1][0]
+                                offset = self.measure_to_offset(timing_map, new_start_measure)
+                                ms_per_measure = osu_timings[m_idx - 1][3]
 
                                 for i in timing_remove:
-                                    self.diff_timings[diff_idx].pop(i)
+                                    osu_timings.pop(i)
                                 
-                                self.diff_timings[diff_idx].insert(0, [bpm, new_start_measure, offset, ms_per_measure])
+                                osu_timings.insert(0, [bpm, new_start_measure, offset, ms_per_measure])
                                 break
 
 
-            for t_idx in range(len(self.diff_timings[diff_idx])):
-                t: list = self.diff_timings[diff_idx][t_idx] # t = [bpm, measure, offset, ms_per_measure]
+            for t in osu_timings:
                 offset = t[2]
                 ms_per_measure = t[3]
                 if self.flag_nsv:
@@ -718,61 +819,52 @@ class OJNExtract():
                 if self.flag_nsv:
                     break
            
-            osu_hitobjects = ["[HitObjects]"]
-            
-            # populate all notes in osu format
-            osu_col_coord = [math.floor((512 / 7) * (i + 0.5)) for i in range(7)]
-            for n in self.diff_notes[diff_idx]:
-                sample_id = n['sample_value'] + 1
-                offset = get_note_offset(n['measure_start'])
-
-                if sample_id not in self.ojm.sound_dict:
-                    flag_no_keysound = True
-                    ext = None
-                else:
-                    flag_no_keysound = False
-                    ext = self.ojm.sound_dict[sample_id]
-                
-                
-                hitsound = f"normal-hitnormal{sample_id}.{ext}"
+            # populate all notes in osu format (hitsound is None if there's no keysound)
+            note_offsets = self.measure_to_offset(timing_map, notes["measure_start"])
+            note_offsets_end = self.measure_to_offset(timing_map, np.where(notes["type"] == 1, notes["measure_end"], notes["measure_start"]))
+            note_hitsounds = [f"normal-hitnormal{sample_id}.{self.ojm.sound_dict[sample_id]}" if sample_id in self.ojm.sound_dict else None for sample_id in (notes["sample_value"] + 1).tolist()]
 
-                if self.flag_use_mp3 and not flag_no_keysound:
-                    # minus self.extra_offset here because extra offset should only apply to chart, not the song
-                    curr_mp3_remix_list.append([offset - self.extra_offset, hitsound])
-                
-                if n["type"] == 0:
-                    res_str = f"1,0,0:0:0"
-                else: # ln needs offset_end
-                    offset_end = get_note_offset(n['measure_end'])
-                    res_str = f"128,0,{offset_end}:0:0:0"
-                
+            if self.flag_use_mp3:
+                # minus self.extra_offset here because extra offset should only apply to chart, not the song
+                curr_mp3_remix_list.extend([offset - self.extra_offset, hitsound] for offset, hitsound in zip(note_offsets, note_hitsounds) if hitsound is not None)
 
-                if flag_no_keysound or self.flag_use_mp3:
-                    osu_hitobjects.append(f"{osu_col_coord[n['lane']]},0,{offset},{res_str}:0:")
-                else:
-                    osu_hitobjects.append(f"{osu_col_coord[n['lane']]},0,{offset},{res_str}:100:{hitsound}")
+            osu_hitobjects = self.get_osu_hitobjects(notes, note_offsets, note_offsets_end, note_hitsounds)
 
 
-            # Create MP3
-            if self.flag_use_mp3:
-                if self.duration[diff_idx] not in mp3_dict:
+            # Create MP3 (only queued here, see render_audio)
+            audio_filename = "virtual" # used by osu_general
+            if self.flag_use_mp3 and len(curr_mp3_remix_list) > 0:
+                fingerprint = self.get_remix_fingerprint(curr_mp3_remix_list, sound_keys)
+                if fingerprint not in mp3_dict:
                     output_filename = f"audio_{self.song_id}.mp3"
                     if len(mp3_dict) > 0:
                         output_filename = f"audio_{self.song_id}_{self.diff_scale[diff_idx]}.mp3"
                     
-                    if len(curr_mp3_remix_list) == 1:
-                        sound_filename = curr_mp3_remix_list[0][1]
-                        audio_lib.to_mp3(self.song_path, sound_filename, output_filename)
-                    elif len(curr_mp3_remix_list) > 1:
-                        audio_lib.merge_mp3(self.song_path, curr_mp3_remix_list, output_filename)
-                    
-                    audio_filename = output_filename # used by osu_general    
-                    # always preview at 1/4 duration of the song
-                    preview_time = math.floor(audio_lib.get_audio_length(self.song_path, audio_filename) / 4) # used by osu_general
-
-                    mp3_dict[self.duration[diff_idx]] = output_filename
-            
+                    render_jobs.append([output_filename, curr_mp3_remix_list])
+                    mp3_dict[fingerprint] = output_filename
+                audio_filename = mp3_dict[fingerprint]
             
+            sections = [
+                osu_editor,
+                osu_metadata,
+                osu_difficulty,
+                osu_events,
+                osu_timing_points,
+                osu_hitobjects
+            ]
+
+            osu_filename = os.path.join(self.song_path, self.safe_filename(f"{self.artist} - {self.title} ({self.noter}) [lvl {self.lvl[diff_idx]}].osu"))
+            osu_diffs.append([osu_filename, audio_filename, sections])
+
+        with profile_lib.profiler.stage("render"):
+            self.render_audio(render_jobs)
+
+        for osu_filename, audio_filename, sections in osu_diffs:
+            # always preview at 1/4 duration of the song (duration of the rendered audio, no need to decode the mp3 again)
+            preview_time = "1234"
+            if audio_filename in self.audio_info:
+                preview_time = math.floor(self.audio_info[audio_filename]["duration"] / 4)
+
             osu_general = [
                 "[General]",
                 f"AudioFilename: {audio_filename}",
@@ -786,27 +878,9 @@ class OJNExtract():
                 "SpecialStyle: 0",
                 "WidescreenStoryboard: 1"
             ]
-            
-            sections = [
-                osu_general,
-                osu_editor,
-                osu_metadata,
-                osu_difficulty,
-                osu_events,
-                osu_timing_points,
-                osu_hitobjects
-            ]
 
-            for idx in range(len(sections)):
-                for line in sections[idx]:
-                    osu_file += line + "\n"
-                if idx != len(sections) - 1:
-                    osu_file += "\n\n"
-            
-            
-            osu_filename = os.path.join(self.song_path, self.safe_filename(f"{self.artist} - {self.title} ({self.noter}) [lvl {self.lvl[diff_idx]}].osu"))
-            with open((osu_filename), "w", encoding="utf-8") as f:
-                f.write(osu_file)
+            with profile_lib.profiler.stage("osu_write"), open((osu_filename), "w", encoding="utf-8") as f:
+                self.write_osu(f, [osu_general] + sections)
 
         # generate .jpg
         jpg_filename = os.path.join(self.song_path, f"background_{self.song_id}.jpg")
@@ -818,36 +892,332 @@ class OJNExtract():
 
         if self.flag_use_mp3:
             audio_lib.clean_up(self.song_path)
+            if self.debug:
+                print(f"pcm_cache = {audio_lib.pcm_cache.stats()}")
+
+
+    # same fingerprint -> same mix (events sorted, since the order doesn't change the mix)
+    # remix_list -> [time (ms), sound_filename], the samples are identified by content, not by sample id
+    # sound_keys -> {sound_filename: key} cache shared by the diffs of the song
+    def get_remix_fingerprint(self, remix_list, sound_keys):
+        for _, sound_filename in remix_list:
+            if sound_filename not in sound_keys:
+                data = audio_lib.read_sound(self.song_path, sound_filename, self.ojm.sound_buffers)
+                sound_keys[sound_filename] = audio_lib.get_sound_key(data, sound_filename.split(".")[-1])
+        fingerprint = hashlib.blake2b(digest_size=16)
+        for offset, sound_key in sorted((offset, sound_keys[sound_filename]) for offset, sound_filename in remix_list):
+            fingerprint.update(f"{offset},{sound_key};".encode())
+        return fingerprint.hexdigest()
+
+    # render the mp3 of every job (one per distinct diff), several at the same time when render_threads > 1
+    # jobs -> [[output_filename, remix_list]], results go to self.audio_info
+    def render_audio(self, jobs):
+        stack = profile_lib.profiler.get_stack()
+        def render(output_filename, remix_list):
+            with profile_lib.profiler.inherit(stack):
+                if len(remix_list) == 1:
+                    return audio_lib.to_mp3(self.song_path, remix_list[0][1], output_filename, self.ojm.sound_buffers)
+                return audio_lib.merge_mp3(self.song_path, remix_list, output_filename, self.ojm.sound_buffers, threads=self.decode_threads, window_ms=self.mix_window_ms)
+
+        if self.render_threads > 1 and len(jobs) > 1:
+            with ThreadPoolExecutor(max_workers=self.render_threads) as executor:
+                futures = [executor.submit(render, *job) for job in jobs]
+                results = [future.result() for future in futures]
+        else:
+            results = [render(*job) for job in jobs]
 
+        for (output_filename, remix_list), audio_info in zip(jobs, results):
+            self.audio_info[output_filename] = audio_info
 
-    # use OJMExtract to extract audio files
+    # use OJMExtract to index audio files (ojm.sound_dict is ready after this, nothing is extracted yet)
     def parse_audio(self):
         self.ojm = OJMExtract()
         self.ojm.song_path = self.song_path
-        self.ojm.enc = self.enc
+        self.ojm.enc = self.text_enc
         self.ojm.debug = self.debug
         self.ojm.input_path = self.input_path
         self.ojm.output_path = self.output_path
-        self.ojm.dump_file(self.curr_ojn_file.replace(".ojn", ".ojm"))
+        # .osu files reference the hitsound files directly when not using mp3
+        self.ojm.flag_in_memory = self.flag_use_mp3 and self.flag_in_memory
+        self.ojm.build_index(self.curr_ojn_file.replace(".ojn", ".ojm"))
+
+    # sample ids referenced by the diffs that will be exported (call after parse_diff)
+    def get_used_samples(self):
+        used_samples = set()
+        for diff_idx in range(len(self.diff_size)):
+            if self.skip_diff[diff_idx]:
+                continue
+            used_samples.update((self.diff_notes[diff_idx]["sample_value"] + 1).tolist())
+            used_samples.update(self.diff_autoplay_samples[diff_idx]["sample_id"].tolist())
+        return used_samples
+
+    # only extract the samples that are actually used by the charts
+    def extract_audio(self):
+        used_samples = self.get_used_samples()
+        profile_lib.profiler.count("samples", len(used_samples))
+        self.ojm.extract_samples(used_samples)
     
     
-    def o2jam_to_osu(self, ojn_list):
+    def load_manifest(self):
+        manifest_file = os.path.join(self.output_path, self.manifest_filename)
+        if not os.path.exists(manifest_file):
+            return {}
+        with open(manifest_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_manifest(self, manifest):
+        os.makedirs(self.output_path, exist_ok=True)
+        manifest_file = os.path.join(self.output_path, self.manifest_filename)
+        # write to a temp file first so an interrupted save never leaves a broken manifest
+        with open(manifest_file + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+        os.replace(manifest_file + ".tmp", manifest_file)
+
+    # {"size", "mtime", "sha1"} of an input file
+    # the hash is only computed again when size or mtime changed since prev_info
+    def get_file_info(self, filename, prev_info=None):
+        st = os.stat(filename)
+        file_info = {"size": st.st_size, "mtime": st.st_mtime_ns}
+        if prev_info is not None and prev_info["size"] == file_info["size"] and prev_info["mtime"] == file_info["mtime"]:
+            file_info["sha1"] = prev_info["sha1"]
+            return file_info
+
+        sha1 = hashlib.sha1()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(chunk)
+        file_info["sha1"] = sha1.hexdigest()
+        return file_info
+
+    # manifest entry of the current song (outputs are filled in after a successful conversion)
+    def get_manifest_entry(self, ojn, prev_entry=None):
+        ojm = ojn.replace(".ojn", ".ojm")
+        return {
+            "ojn": self.get_file_info(os.path.join(self.input_path, ojn), prev_entry and prev_entry["ojn"]),
+            "ojm": self.get_file_info(os.path.join(self.input_path, ojm), prev_entry and prev_entry["ojm"]),
+            "settings": self.get_output_settings(),
+            "song_path": os.path.basename(self.song_path),
+            "outputs": [],
+            "complete": False
+        }
+
+    # same inputs, same settings, finished last time and every output still there
+    # an output modified after the conversion finished means a later conversion of the song was interrupted
+    def is_up_to_date(self, entry, prev_entry):
+        if prev_entry is None or not prev_entry["complete"]:
+            return False
+        for key in ["settings", "song_path"]:
+            if entry[key] != prev_entry[key]:
+                return False
+        for key in ["ojn", "ojm"]:
+            if entry[key]["sha1"] != prev_entry[key]["sha1"]:
+                return False
+        for output in prev_entry["outputs"]:
+            output_file = os.path.join(self.song_path, output)
+            if not os.path.exists(output_file):
+                return False
+            if "finished" in prev_entry and os.path.getmtime(output_file) > prev_entry["finished"]:
+                return False
+        return True
+
+    # {filename: mtime (ns)} of the files in song_path
+    def list_song_files(self):
+        files = {}
+        for filename in os.listdir(self.song_path):
+            file_path = os.path.join(self.song_path, filename)
+            if os.path.isfile(file_path):
+                files[filename] = os.stat(file_path).st_mtime_ns
+        return files
+
+    # files of song_path written since list_song_files() returned existing_files
+    def get_written_files(self, existing_files):
+        files = self.list_song_files()
+        return sorted(x for x in files if files[x] != existing_files.get(x))
+
+    # name of the output folder of a song (in output_path)
+    def get_song_folder(self, artist, title, song_id):
+        return self.safe_filename(f"{artist} - {title} ({song_id})")
+
+    # ojn files that would be converted into the same folder as another ojn of ojn_list (e.g. the same chart
+    # from 2 servers), converting both would make them overwrite and remove each other's outputs
+    # the one that already owns the folder in the manifest (or else the first one) is kept
+    # returns {ojn: ojn converted into that folder instead}
+    def find_song_path_collisions(self, ojn_list, manifest):
+        owners = {} # {song folder: ojn}
         for ojn in ojn_list:
-            self.curr_ojn_file = ojn
+            entry = manifest.get(ojn)
+            if entry is not None and entry["complete"]:
+                owners.setdefault(entry["song_path"], ojn)
+
+        collisions = {}
+        for ojn in ojn_list:
+            try:
+                h = self.unpack_ojn_header(self.read_ojn_header(ojn), self.enc, encoding_lib.get_server(ojn))
+            except Exception:
+                continue # convert_song reports it
+            song_folder = self.get_song_folder(h["artist"], h["title"], h["song_id"])
+            owner = owners.setdefault(song_folder, ojn)
+            if owner != ojn:
+                collisions[ojn] = owner
+        return collisions
+
+    # remove the outputs of a previous (outdated or partial) conversion
+    def remove_outputs(self, prev_entry):
+        if prev_entry is None:
+            return
+        prev_song_path = os.path.join(self.output_path, prev_entry["song_path"])
+        for output in prev_entry["outputs"]:
+            output_file = os.path.join(prev_song_path, output)
+            if os.path.exists(output_file):
+                os.remove(output_file)
+
+    # convert a single song
+    # prev_entry -> manifest entry of the last conversion (None if never converted)
+    # returns ("success" or "skip", manifest entry)
+    def convert_song(self, ojn, prev_entry=None):
+        self.curr_ojn_file = ojn
+        with profile_lib.profiler.stage("parse_ojn_header"):
             self.parse_ojn_header(ojn)
+        try:
             if self.debug:
                 self._ojn_header_debug()
-            self.song_path = os.path.join(self.output_path, self.safe_filename(f"{self.artist} - {self.title} ({self.song_id})"))
+            self.song_path = os.path.join(self.output_path, self.get_song_folder(self.artist, self.title, self.song_id))
             
-            if os.path.exists(self.song_path):
-                self.info_log(f"Song id = {self.song_id} exists, skip!")
-            else:
-                self.info_log(f"Song id = {self.song_id}, parsing...")
-                # create directory if not exist
-                # https://stackoverflow.com/questions/12517451/automatically-creating-directories-with-file-output
-                os.makedirs(os.path.dirname(os.path.join(self.song_path, "cow.osu")), exist_ok=True)
+            entry = self.get_manifest_entry(ojn, prev_entry)
+            if self.is_up_to_date(entry, prev_entry):
+                self.info_log(f"Song id = {self.song_id} is up to date, skip!")
+                return "skip", prev_entry
+
+            self.remove_outputs(prev_entry)
+            self.info_log(f"Song id = {self.song_id}, parsing...")
+            # create directory if not exist
+            # https://stackoverflow.com/questions/12517451/automatically-creating-directories-with-file-output
+            os.makedirs(os.path.dirname(os.path.join(self.song_path, "cow.osu")), exist_ok=True)
+            # anything else in the folder (e.g. added by the user) isn't an output of this song
+            existing_files = self.list_song_files()
+            audio_lib.pcm_cache.set_budget(self.pcm_cache_size)
+            audio_lib.set_ffmpeg_limit(self.get_ffmpeg_limit())
+            profiler = profile_lib.profiler
+            with profiler.stage("parse_audio"):
                 self.parse_audio()
+            with profiler.stage("parse_image"):
                 self.parse_image()
+            with profiler.stage("parse_diff"):
                 self.parse_diff()
+            with profiler.stage("extract_audio"):
+                self.extract_audio()
+            with profiler.stage("export_osu"):
                 self.export_osu()
-                self.info_log(f"Song id = {self.song_id}, success!")
\ No newline at end of file
+
+            entry["outputs"] = self.get_written_files(existing_files)
+            entry["complete"] = True
+            entry["finished"] = time.time() # after every output is written, see is_up_to_date
+            self.info_log(f"Song id = {self.song_id}, success!")
+            return "success", entry
+        finally:
+            self.close_ojn()
+
+    # same as convert_song, but a failing song is reported and returns ("failed", None) instead of stopping the batch
+    def try_convert_song(self, ojn, prev_entry=None):
+        try:
+            return self.convert_song(ojn, prev_entry)
+        except Exception:
+            print(f"[ERROR] {ojn}: conversion failed!")
+            print(traceback.format_exc(), end="")
+            return "failed", None
+
+    # try_convert_song with the stage profiler on when profile_filename is set
+    # returns (status, manifest entry, profile record or None)
+    def profile_convert_song(self, ojn, prev_entry=None):
+        if self.profile_filename is None:
+            return (*self.try_convert_song(ojn, prev_entry), None)
+
+        profile_lib.profiler.start()
+        try:
+            start_time = time.perf_counter()
+            status, entry = self.try_convert_song(ojn, prev_entry)
+            elapsed = time.perf_counter() - start_time
+        finally:
+            record = profile_lib.profiler.stop()
+        record = {"ojn": ojn, "status": status, "wall": round(elapsed, 6), "pid": os.getpid(), **record}
+        return status, entry, record
+
+    # convert all songs in ojn_list (in parallel when self.workers > 1)
+    # returns {"success": [ojn, ...], "skip": [...], "failed": [...], "collision": [...]}
+    def o2jam_to_osu(self, ojn_list):
+        status = {}
+        manifest = self.load_manifest()
+        prev_entries = {ojn: manifest.get(ojn) for ojn in ojn_list}
+
+        collisions = self.find_song_path_collisions(ojn_list, manifest)
+        for ojn, owner in collisions.items():
+            print(f"[WARNING] {ojn} has the same output folder as {owner}, only {owner} is converted")
+            status[ojn] = "collision"
+        convert_list = [ojn for ojn in ojn_list if ojn not in collisions]
+
+        # entries are only replaced once a song is done, if the run gets killed a song that was being converted
+        # still has its old entry, but its outputs are missing or newer than the entry (see is_up_to_date)
+        last_save = time.monotonic()
+
+        os.makedirs(self.output_path, exist_ok=True)
+        profile_file = None
+        if self.profile_filename is not None:
+            profile_file = open(os.path.join(self.output_path, self.profile_filename), "a", encoding="utf-8")
+
+        def finish(ojn, song_status, entry, record=None):
+            nonlocal last_save
+            status[ojn] = song_status
+            if entry is not None:
+                manifest[ojn] = entry
+            elif ojn in manifest:
+                # failed, the old outputs might be half replaced
+                manifest[ojn] = dict(manifest[ojn], complete=False)
+            if record is not None:
+                profile_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                profile_file.flush()
+            # don't rewrite the whole manifest after every single song
+            if time.monotonic() - last_save > 5:
+                self.save_manifest(manifest)
+                last_save = time.monotonic()
+
+        try:
+            if self.workers > 1:
+                settings = self.get_settings()
+                with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                    futures = {executor.submit(convert_song_worker, settings, ojn, prev_entries[ojn]): ojn for ojn in convert_list}
+                    for future in as_completed(futures):
+                        ojn = futures[future]
+                        try:
+                            song_status, entry, log, record = future.result()
+                        except Exception as e:
+                            # the worker process itself died
+                            song_status, entry, log, record = "failed", None, f"[ERROR] {ojn}: worker failed! {e!r}\n", None
+                        # print the whole log of a song at once so lines from different songs don't interleave
+                        print(log, end="", flush=True)
+                        finish(ojn, song_status, entry, record)
+            else:
+                for ojn in convert_list:
+                    finish(ojn, *self.profile_convert_song(ojn, prev_entries[ojn]))
+        finally:
+            # also when interrupted, so the songs that did finish aren't converted again next time
+            self.save_manifest(manifest)
+            if profile_file is not None:
+                profile_file.close()
+
+        summary = {"success": [], "skip": [], "failed": [], "collision": []}
+        for ojn in ojn_list:
+            summary[status[ojn]].append(ojn)
+        self.info_log(f"{len(summary['success'])} converted, {len(summary['skip'])} skipped, {len(summary['failed'])} failed, {len(summary['collision'])} output folder collisions")
+        return summary
+
+
+# runs in a worker process: convert one song with a fresh OJNExtract, the log is returned instead of printed
+def convert_song_worker(settings, ojn, prev_entry):
+    cow = OJNExtract()
+    for name, value in settings.items():
+        setattr(cow, name, value)
+
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        status, entry, record = cow.profile_convert_song(ojn, prev_entry)
+    return status, entry, log.getvalue(), record
@@ -1,20 +1,164 @@
 from pydub import AudioSegment
-from pydub.utils import mediainfo
+from pydub.utils import mediainfo_json, ratio_to_db
+from pydub.exceptions import CouldntEncodeError
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import threading
+import hashlib
+import struct
+import io
 import os
+import subprocess
+import tempfile
+import profile_lib
+
+# sample_width -> numpy dtype of AudioSegment raw data
+PCM_DTYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+
+# LRU cache of decoded sounds (AudioSegment), keyed by a hash of the encoded file content
+# Identical hitsounds are only decoded once, across diffs and across songs in the same process
+# Thread safe (merge_mp3 decodes in a thread pool, export_osu renders the diffs in parallel)
+class PCMCache():
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes # budget for the decoded (raw) data
+        self.size = 0
+        self.entries = OrderedDict() # {key: AudioSegment}, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            sound = self.entries.get(key)
+            if sound is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return sound
+
+    def put(self, key, sound):
+        sound_size = len(sound.raw_data)
+        with self.lock:
+            if key in self.entries or sound_size > self.max_bytes:
+                return
+            self.entries[key] = sound
+            self.size += sound_size
+            self.evict()
+
+    # call with self.lock held
+    def evict(self):
+        while self.size > self.max_bytes:
+            key, sound = self.entries.popitem(last=False)
+            self.size -= len(sound.raw_data)
+            self.evictions += 1
+
+    def set_budget(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+pcm_cache = PCMCache()
+
+# Caps the number of ffmpeg / ffprobe processes running at the same time in this process
+# (decode threads of merge_mp3 + the diffs rendered in parallel by export_osu)
+# With o2jam_to_osu workers > 1 every worker process has its own limit, see OJNExtract.get_ffmpeg_limit()
+ffmpeg_limit = os.cpu_count() or 1
+ffmpeg_semaphore = threading.BoundedSemaphore(ffmpeg_limit)
+
+# call between songs only (not while another thread is waiting on the semaphore)
+def set_ffmpeg_limit(limit: int):
+    global ffmpeg_limit, ffmpeg_semaphore
+    limit = max(1, limit)
+    if limit != ffmpeg_limit:
+        ffmpeg_limit = limit
+        ffmpeg_semaphore = threading.BoundedSemaphore(limit)
+
+# cache key of an encoded sound, the format is part of the key because it decides how the data is decoded
+def get_sound_key(data: bytes, sound_ext: str) -> str:
+    return f"{sound_ext}:{hashlib.blake2b(data, digest_size=16).hexdigest()}"
+
+# encoded sound data, from sound_buffers if it's there, otherwise from the song folder
+# sound_buffers -> {sound_filename: bytes} (OJMExtract.sound_buffers), None = everything is on disk
+def read_sound(folder_path: str, sound_filename: str, sound_buffers: dict = None) -> bytes:
+    if sound_buffers is not None and sound_filename in sound_buffers:
+        return sound_buffers[sound_filename]
+    with open(os.path.join(folder_path, sound_filename), "rb") as f:
+        return f.read()
 
 # load sound and return AudioSegment object
 # folder_path -> song folder path (self.song_path in OJNExtract)
 # sound_filename -> "normal-hitnormal1002.ogg"
-def load_sound(folder_path: str, sound_filename: str):
+def load_sound(folder_path: str, sound_filename: str, sound_buffers: dict = None):
     sound_ext = sound_filename.split(".")[-1]
-    sound_file = os.path.join(folder_path, sound_filename)
-    sound = AudioSegment.from_file((sound_file), format=sound_ext)
+    data = read_sound(folder_path, sound_filename, sound_buffers)
+
+    key = get_sound_key(data, sound_ext)
+    sound = pcm_cache.get(key)
+    if sound is None:
+        # pydub reads wav by itself, everything else goes through ffmpeg
+        if sound_ext == "wav":
+            sound = AudioSegment.from_file(io.BytesIO(data), format=sound_ext)
+        else:
+            with ffmpeg_semaphore:
+                sound = AudioSegment.from_file(io.BytesIO(data), format=sound_ext)
+        pcm_cache.put(key, sound)
     return sound
 
+# {sound key (get_sound_key): original bitrate}
+bitrate_cache = {}
+
+# bitrate of an encoded sound read from its own header, this is ffprobe's stream bit_rate
+# (not the format bit_rate that mediainfo used to return, that one is file size / duration, so it can differ a bit)
+# ogg -> nominal bitrate in the vorbis identification header
+# wav -> byte rate in the fmt chunk * 8 (the "bit_rate" field of the OMC wav header)
+# returns None if the header doesn't have it
+def get_header_bitrate(data: bytes, sound_ext: str):
+    if sound_ext == "ogg":
+        # packet type (1) + "vorbis", then version, channels, sample rate, bitrate max/nominal/min
+        pos = data.find(b"\x01vorbis", 0, 4096)
+        if pos >= 0 and len(data) >= pos + 28:
+            version, channels, sample_rate, bitrate_max, bitrate_nominal, bitrate_min = struct.unpack_from("<IBIiii", data, pos + 7)
+            if bitrate_nominal > 0:
+                return bitrate_nominal
+    elif sound_ext == "wav":
+        # walk the RIFF chunks until "fmt "
+        pos = 12
+        while pos + 8 <= len(data):
+            chunk_id, chunk_size = struct.unpack_from("<4sI", data, pos)
+            if chunk_id == b"fmt " and pos + 20 <= len(data):
+                audio_format, num_channels, sample_rate, byte_rate = struct.unpack_from("<HHII", data, pos + 8)
+                return byte_rate * 8
+            pos += 8 + chunk_size + (chunk_size & 1)
+    return None
+
 # Calculate target bitrate
-# sound_file -> full filepath
-def get_target_bitrate(sound_file: str):
-    original_bitrate = mediainfo(sound_file)['bit_rate']
+# The original bitrate comes from the sound header (no ffprobe process), mediainfo is only the fallback
+def get_target_bitrate(folder_path: str, sound_filename: str, sound_buffers: dict = None):
+    sound_ext = sound_filename.split(".")[-1]
+    data = read_sound(folder_path, sound_filename, sound_buffers)
+    key = get_sound_key(data, sound_ext)
+
+    if key not in bitrate_cache:
+        original_bitrate = get_header_bitrate(data, sound_ext)
+        if original_bitrate is None:
+            # the stream has no bit_rate in that case (e.g. vorbis nominal bitrate 0), the format one always exists
+            with ffmpeg_semaphore:
+                original_bitrate = mediainfo_json(io.BytesIO(data))['format']['bit_rate']
+        bitrate_cache[key] = original_bitrate
+    original_bitrate = bitrate_cache[key]
     mp3_bitrates = [128000, 192000, 320000]
     temp_bitrates = [x - int(original_bitrate) for x in mp3_bitrates]
     closest_result = min(temp_bitrates, key=abs)
@@ -22,45 +166,181 @@ def get_target_bitrate(sound_file: str):
     target_bitrate = mp3_bitrates[idx]
     return target_bitrate
 
+# metadata of the audio that was just encoded, so callers don't have to decode the mp3 again
+def get_audio_info(sound, target_bitrate) -> dict:
+    return make_audio_info(len(sound), sound.frame_rate, sound.channels, sound.sample_width, sound.max, target_bitrate)
+
+# same values as the AudioSegment properties (len(), max, max_dBFS), for audio that never was an AudioSegment
+def make_audio_info(duration, frame_rate, channels, sample_width, peak, target_bitrate) -> dict:
+    return {
+        "duration": duration, # ms
+        "frame_rate": frame_rate,
+        "channels": channels,
+        "sample_width": sample_width,
+        "peak": peak, # highest absolute sample value
+        "peak_dBFS": ratio_to_db(peak, (2 ** (sample_width * 8)) / 2),
+        "bitrate": target_bitrate
+    }
+
 # convert a single file to mp3
 # folder_path -> song folder path (self.song_path in OJNExtract)
 # sound_filename -> "normal-hitnormal1002.ogg"
 # output_filename -> "audio_1237.mp3"
-def to_mp3(folder_path: str, sound_filename: str, output_filename: str):
+# sound_buffers -> in-memory hitsounds, see read_sound()
+# returns get_audio_info() of the exported audio
+def to_mp3(folder_path: str, sound_filename: str, output_filename: str, sound_buffers: dict = None):
     print(f"{sound_filename} -> {output_filename}")
-    sound_file = os.path.join(folder_path, sound_filename)
 
     # import source audio file
-    sound = load_sound(folder_path, sound_filename)
+    with profile_lib.profiler.stage("decode"):
+        sound = load_sound(folder_path, sound_filename, sound_buffers)
     
     # determine output target bitrate
-    target_bitrate = get_target_bitrate(sound_file)
+    target_bitrate = get_target_bitrate(folder_path, sound_filename, sound_buffers)
 
     # export mp3
-    sound.export(os.path.join(folder_path, f"{output_filename}"), format="mp3", bitrate=str(target_bitrate))
+    with profile_lib.profiler.stage("encode"), ffmpeg_semaphore:
+        sound.export(os.path.join(folder_path, f"{output_filename}"), format="mp3", bitrate=str(target_bitrate))
+    return get_audio_info(sound, target_bitrate)
+
+# common format of a mix, same one that overlay() on top of AudioSegment.silent() ends up with
+# snd_dict -> {sound_filename: {"duration", "audio_segment"}}
+# returns (channels, frame_rate, sample_width, {sound_filename: samples converted to that format})
+def convert_sounds(snd_dict: dict):
+    segments = [snd["audio_segment"] for snd in snd_dict.values()]
+    channels = max([1] + [x.channels for x in segments])
+    frame_rate = max([11025] + [x.frame_rate for x in segments])
+    sample_width = max([2] + [x.sample_width for x in segments])
+    if sample_width == 3:
+        sample_width = 4
+    dtype = PCM_DTYPES[sample_width]
+
+    pcm_dict = {}
+    for snd_name, snd in snd_dict.items():
+        sound = snd["audio_segment"].set_channels(channels).set_frame_rate(frame_rate).set_sample_width(sample_width)
+        pcm_dict[snd_name] = np.frombuffer(sound.raw_data, dtype=dtype)
+    return channels, frame_rate, sample_width, pcm_dict
+
+# length of the mix in samples (all channels)
+def get_mix_length(remix_list: list, frame_rate: int, channels: int) -> int:
+    mp3_duration = max([snd[2] for snd in remix_list])
+    return int(frame_rate * (mp3_duration / 1000.0)) * channels
+
+# where every event of remix_list goes in the mix, sorted by start
+# returns [(start, end, samples)], samples is already cut to end - start
+def get_mix_events(remix_list: list, pcm_dict: dict, frame_rate: int, channels: int, mix_length: int) -> list:
+    events = []
+    for snd in remix_list:
+        pcm = pcm_dict[snd[1]]
+        # same position rounding as AudioSegment.overlay
+        start = int(snd[0] * (frame_rate / 1000.0)) * channels
+        if start < 0:
+            pcm = pcm[-start:]
+            start = 0
+        end = min(start + len(pcm), mix_length)
+        if end > start:
+            events.append((start, end, pcm[:end - start]))
+    events.sort(key=lambda x: x[0])
+    return events
+
+# mix all the hitsounds in remix_list, window_ms at a time, piped straight into one ffmpeg process as raw PCM
+# remix_list -> [start_time, sound_filename, end_time, duration]
+# snd_dict -> {sound_filename: {"duration", "audio_segment"}}
+# Every distinct sound is converted once to a common format (convert_sounds) and only the events overlapping
+# the window are added, so memory is bounded by the window and ffmpeg encodes while the next window is mixed
+# Overlapping events are summed and clipped once (AudioSegment.overlay clips after every single add)
+# output_file -> mp3 file path
+# returns get_audio_info() of the mix, computed along the way
+def stream_mix(remix_list: list, snd_dict: dict, output_file: str, target_bitrate: int, window_ms: int = 10000) -> dict:
+    channels, frame_rate, sample_width, pcm_dict = convert_sounds(snd_dict)
+    dtype = PCM_DTYPES[sample_width]
+    limits = np.iinfo(dtype)
+    mix_length = get_mix_length(remix_list, frame_rate, channels)
+    events = get_mix_events(remix_list, pcm_dict, frame_rate, channels, mix_length)
+    window = max(1, int(frame_rate * window_ms / 1000)) * channels
+
+    conversion_command = [
+        AudioSegment.converter,
+        "-y",
+        "-f", f"s{sample_width * 8}le", "-ar", str(frame_rate), "-ac", str(channels), "-i", "pipe:0",
+        "-b:a", str(target_bitrate),
+        "-f", "mp3", output_file
+    ]
 
-# get audio length in ms (don't call this directly, it's very costly)
-def get_audio_length(folder_path: str, sound_filename: str) -> int:
-    return len(load_sound(folder_path, sound_filename))
+    peak = 0
+    with ffmpeg_semaphore, tempfile.TemporaryFile() as ffmpeg_log:
+        p = subprocess.Popen(conversion_command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=ffmpeg_log)
+        try:
+            next_event = 0
+            active_events = []
+            for window_start in range(0, mix_length, window):
+                window_end = min(window_start + window, mix_length)
+                with profile_lib.profiler.stage("mix"):
+                    # events are sorted by start, so only the ones still playing are kept around
+                    while next_event < len(events) and events[next_event][0] < window_end:
+                        active_events.append(events[next_event])
+                        next_event += 1
+                    active_events = [x for x in active_events if x[1] > window_start]
+
+                    mix = np.zeros(window_end - window_start, dtype=np.int64)
+                    for start, end, pcm in active_events:
+                        overlap_start = max(start, window_start)
+                        overlap_end = min(end, window_end)
+                        mix[overlap_start - window_start:overlap_end - window_start] += pcm[overlap_start - start:overlap_end - start]
+                    np.clip(mix, limits.min, limits.max, out=mix)
+                    peak = max(peak, int(np.abs(mix).max()))
+                    data = mix.astype(dtype).tobytes()
+
+                with profile_lib.profiler.stage("encode"):
+                    p.stdin.write(data)
+            p.stdin.close()
+        except BrokenPipeError:
+            pass # ffmpeg quit early, the reason is in its output
+        except BaseException:
+            p.kill()
+            p.wait()
+            raise
+
+        with profile_lib.profiler.stage("encode"):
+            returncode = p.wait()
+        if returncode != 0:
+            ffmpeg_log.seek(0)
+            if os.path.exists(output_file):
+                os.remove(output_file)
+            raise CouldntEncodeError(
+                f"Encoding failed. ffmpeg/avlib returned error code: {returncode}\n\nCommand:{conversion_command}\n\n"
+                f"Output from ffmpeg/avlib:\n\n{ffmpeg_log.read().decode(errors='ignore')}")
+
+    duration = round(1000 * (mix_length // channels / frame_rate))
+    return make_audio_info(duration, frame_rate, channels, sample_width, peak, target_bitrate)
 
 # use curr_mp3_remix_list from OJNExtract to merge mp3
 # folder_path -> song folder path (self.song_path in OJNExtract)
 # remix_list -> [time (ms), sound_filename ("normal-hitnormal1002.ogg")]
 # output_filename -> "audio_1237.mp3"
-def merge_mp3(folder_path: str, remix_list: list, output_filename: str):
+# sound_buffers -> in-memory hitsounds, see read_sound()
+# threads -> number of hitsounds decoded at the same time (ffmpeg runs outside the GIL)
+# window_ms -> length of the pieces the mix is rendered and encoded in, see stream_mix()
+# returns get_audio_info() of the exported audio
+def merge_mp3(folder_path: str, remix_list: list, output_filename: str, sound_buffers: dict = None, threads: int = 1, window_ms: int = 10000):
     print(f"All hitsounds (x{len(remix_list)}) -> {output_filename}, this might take a while...")
-    snd_lst = {x[1] for x in remix_list}
+    snd_lst = list({x[1] for x in remix_list})
     snd_dict = {}
 
     # load all hitsound
-    for snd_name in snd_lst:
-        sound = load_sound(folder_path, snd_name)
-        duration = len(sound)
-        snd_dict[snd_name] = {}
-        snd_dict[snd_name]["duration"] = duration
-        snd_dict[snd_name]["audio_segment"] = sound
-
-    # calculate mp3 duration
+    with profile_lib.profiler.stage("decode"):
+        if threads > 1 and len(snd_lst) > 1:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                sounds = list(executor.map(lambda snd_name: load_sound(folder_path, snd_name, sound_buffers), snd_lst))
+        else:
+            sounds = [load_sound(folder_path, snd_name, sound_buffers) for snd_name in snd_lst]
+        for snd_name, sound in zip(snd_lst, sounds):
+            duration = len(sound)
+            snd_dict[snd_name] = {}
+            snd_dict[snd_name]["duration"] = duration
+            snd_dict[snd_name]["audio_segment"] = sound
+
+    # calculate mix duration
     for snd in remix_list:
         start_time = snd[0]
         sound_filename = snd[1]
@@ -68,22 +348,15 @@ def merge_mp3(folder_path: str, remix_list: list, output_filename: str):
         end_time = start_time + duration
         snd.extend([end_time, duration]) # snd -> [start_time, sound_filename, end_time, duration]
     
-    mp3_duration = max([snd[2] for snd in remix_list])
-    mp3 = AudioSegment.silent(duration=mp3_duration)
-
-    # overlay all the hitsounds to the silent mp3
-    for snd in remix_list:
-        sound = snd_dict[snd[1]]["audio_segment"]
-        mp3 = mp3.overlay(sound, position=snd[0])
+    profile_lib.profiler.count("remix_events", len(remix_list))
 
     # find the bitrate
     remix_list.sort(key=lambda x: x[3])
     sound_filename = remix_list[-1][1]
-    sound_file = os.path.join(folder_path, sound_filename)
-    target_bitrate = get_target_bitrate(sound_file)
+    target_bitrate = get_target_bitrate(folder_path, sound_filename, sound_buffers)
     
-    # finally export mp3
-    mp3.export(os.path.join(folder_path, f"{output_filename}"), format="mp3", bitrate=str(target_bitrate))
+    # mix all the hitsounds and export mp3
+    return stream_mix(remix_list, snd_dict, os.path.join(folder_path, f"{output_filename}"), target_bitrate, window_ms)
 
 
 def clean_up(folder_path: str):
@@ -0,0 +1,208 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import contextlib
+import numpy as np
+from pydub.utils import which
+import audio_lib
+import synth_corpus
+from OJNExtract import OJNExtract
+from OJMExtract import OJMExtract
+
+# Benchmark runner: times each stage of the conversion separately on a (synthetic) corpus
+# and prints the results as JSON, so runs can be compared over time
+# e.g. python benchmark.py --songs 3 --notes 5000 --output bench.json
+
+
+# run func() repeat times (converter output is discarded)
+# returns (result of the last run, best wall time in seconds, tracemalloc peak in bytes of one extra run)
+def measure(func, repeat=3):
+    best = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            result = func()
+            elapsed = time.perf_counter() - start_time
+            if best is None or elapsed < best:
+                best = elapsed
+
+        # tracemalloc slows everything down, so the peak comes from a separate run
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result, best, peak
+
+def stage_result(seconds, peak, amount, unit):
+    return {
+        "seconds": round(seconds, 6),
+        "peak_bytes": peak,
+        "amount": amount,
+        "throughput": round(amount / max(seconds, 1e-9), 1),
+        "unit": f"{unit}/s"
+    }
+
+# OJNExtract set up the way convert_song does it, output goes to song_path
+def new_converter(input_path, song_path, flag_use_mp3=False):
+    cow = OJNExtract()
+    cow.input_path = input_path
+    cow.output_path = os.path.dirname(song_path)
+    cow.flag_use_mp3 = flag_use_mp3
+    cow.flag_in_memory = True
+    cow.song_path = song_path
+    os.makedirs(song_path, exist_ok=True)
+    return cow
+
+def bench_song(input_path, work_path, ojn, repeat, flag_ffmpeg):
+    stages = {}
+    song_path = os.path.join(work_path, ojn.replace(".ojn", ""))
+    cow = new_converter(input_path, song_path)
+    cow.curr_ojn_file = ojn
+
+    # parse_ojn_header
+    def parse_header():
+        cow.parse_ojn_header(ojn)
+        cow.close_ojn()
+    _, seconds, peak = measure(parse_header, repeat)
+    stages["parse_ojn_header"] = stage_result(seconds, peak, 1, "files")
+
+    # parse_diff (needs the ojm index for the autoplay filter)
+    with contextlib.redirect_stdout(io.StringIO()):
+        cow.parse_ojn_header(ojn)
+        cow.parse_audio()
+        cow.parse_image()
+    _, seconds, peak = measure(cow.parse_diff, repeat)
+    note_count = sum(len(cow.diff_notes[diff_idx]) for diff_idx in range(3))
+    stages["parse_diff"] = stage_result(seconds, peak, note_count, "notes")
+    stages["parse_diff"]["diff_bytes"] = sum(cow.diff_size)
+
+    # OJMExtract.dump_file (decode every sample in memory)
+    ojm_filename = ojn.replace(".ojn", ".ojm")
+    def dump_file():
+        ojm = OJMExtract()
+        ojm.input_path = input_path
+        ojm.song_path = song_path
+        ojm.flag_in_memory = True
+        ojm.dump_file(ojm_filename)
+        return ojm
+    ojm, seconds, peak = measure(dump_file, repeat)
+    ojm_size = os.path.getsize(os.path.join(input_path, ojm_filename))
+    stages["dump_file"] = stage_result(seconds, peak, round(ojm_size / 1e6, 3), "MB")
+    stages["dump_file"]["samples"] = len(ojm.sound_buffers)
+
+    # export_osu without mp3 (.osu + .jpg only)
+    with contextlib.redirect_stdout(io.StringIO()):
+        cow.extract_audio()
+    _, seconds, peak = measure(cow.export_osu, repeat)
+    stages["export_osu"] = stage_result(seconds, peak, note_count, "notes")
+
+    # merge_mp3 on the remix lists export_osu builds with flag_use_mp3 (needs ffmpeg to decode ogg and encode mp3)
+    if not flag_ffmpeg:
+        stages["merge_mp3"] = {"skipped": "ffmpeg not found"}
+    else:
+        remix_calls = []
+        merge_mp3 = audio_lib.merge_mp3
+        # only record the calls, the info returned is a placeholder (export_osu just needs a duration)
+        def record_merge_mp3(folder_path, remix_list, output_filename, sound_buffers=None, threads=1, window_ms=10000):
+            remix_calls.append([[list(x) for x in remix_list], output_filename])
+            return audio_lib.make_audio_info(0, 44100, 2, 2, 0, 128000)
+        audio_lib.merge_mp3 = record_merge_mp3
+        try:
+            cow.flag_use_mp3 = True
+            with contextlib.redirect_stdout(io.StringIO()):
+                cow.export_osu()
+        finally:
+            audio_lib.merge_mp3 = merge_mp3
+            cow.flag_use_mp3 = False
+
+        # export_osu with mp3 deletes the extracted hitsounds (audio_lib.clean_up), merge_mp3 needs them back
+        with contextlib.redirect_stdout(io.StringIO()):
+            cow.extract_audio()
+
+        def merge_all():
+            for remix_list, output_filename in remix_calls:
+                merge_mp3(song_path, [list(x) for x in remix_list], output_filename, cow.ojm.sound_buffers)
+        _, seconds, peak = measure(merge_all, repeat)
+        stages["merge_mp3"] = stage_result(seconds, peak, sum(len(x[0]) for x in remix_calls), "events")
+        stages["merge_mp3"]["mixes"] = len(remix_calls)
+
+    return {"ojn": ojn, "stages": stages}
+
+def run_benchmark(input_path, ojn_list, repeat=3):
+    flag_ffmpeg = which("ffmpeg") is not None
+    work_path = tempfile.mkdtemp(prefix="o2jampy_bench_")
+    try:
+        songs = [bench_song(input_path, work_path, ojn, repeat, flag_ffmpeg) for ojn in ojn_list]
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    # sum of every song for each stage
+    total = {}
+    for song in songs:
+        for stage, result in song["stages"].items():
+            if "seconds" not in result:
+                continue
+            if stage not in total:
+                total[stage] = {"seconds": 0, "peak_bytes": 0, "amount": 0, "unit": result["unit"]}
+            total[stage]["seconds"] += result["seconds"]
+            total[stage]["peak_bytes"] = max(total[stage]["peak_bytes"], result["peak_bytes"])
+            total[stage]["amount"] += result["amount"]
+    for result in total.values():
+        result["seconds"] = round(result["seconds"], 6)
+        result["amount"] = round(result["amount"], 3) # same precision as the per song MB of dump_file
+        result["throughput"] = round(result["amount"] / max(result["seconds"], 1e-9), 1)
+
+    return {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "ffmpeg": flag_ffmpeg,
+        "repeat": repeat,
+        "songs": songs,
+        "total": total
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the o2jampy conversion stages")
+    parser.add_argument("--corpus", default=None, help="folder with .ojn/.ojm files (default: generate a synthetic corpus)")
+    parser.add_argument("--songs", type=int, default=3)
+    parser.add_argument("--notes", type=int, default=5000)
+    parser.add_argument("--ln-ratio", type=float, default=0.2)
+    parser.add_argument("--samples", type=int, default=60)
+    parser.add_argument("--sample-ms", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default=None, help="write the JSON report to this file (default: stdout)")
+    args = parser.parse_args()
+
+    corpus_path = args.corpus
+    if corpus_path is None:
+        corpus_path = tempfile.mkdtemp(prefix="o2jampy_corpus_")
+        ojn_list = synth_corpus.generate_corpus(corpus_path, args.songs, notes=args.notes, ln_ratio=args.ln_ratio, samples=args.samples, sample_ms=args.sample_ms, seed=args.seed)
+    else:
+        ojn_list = sorted(x for x in os.listdir(corpus_path) if x.endswith(".ojn"))
+
+    try:
+        report = run_benchmark(corpus_path, ojn_list, args.repeat)
+        report["corpus"] = {"path": args.corpus, "songs": len(ojn_list), "notes": args.notes, "ln_ratio": args.ln_ratio, "samples": args.samples, "sample_ms": args.sample_ms, "seed": args.seed} if args.corpus is None else {"path": args.corpus, "songs": len(ojn_list)}
+    finally:
+        if args.corpus is None:
+            shutil.rmtree(corpus_path, ignore_errors=True)
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,153 @@
+import unicodedata
+import os
+
+# codecs tried by detect_encoding, the first one wins when scores are equal
+# gb18030 - Simplified Chinese
+# euc_kr - Korean
+# big5 - Traditional Chinese
+# shift_jis - Japanese
+CANDIDATES = ["gb18030", "euc_kr", "big5", "shift_jis", "utf-8"]
+
+# most frequent Chinese characters (simplified, then traditional forms that differ)
+# text decoded with the wrong codec hits these far less often than real titles do
+COMMON_HANZI = set(
+    "的一是不了在人有我他这个们中来上大为和国地到以说时要就出会可也你对生能而子那得于着下自之年过发后作里用道行所然家"
+    "种事成方多经么去法学如都同现当没动面起看定天分还进好小部其些主样理心她本前开但因只从想实日军者意无力它与长把机十"
+    "民第公此已工使情明性知全三又关点正业外将两高间由问很最重并物手应战向头文体政美相见被利什二等产或新己制身果加西"
+    "斯月话合回特代内信表化老给世位次度门任常先海通教儿原东声提立及比员解水名真论处走义各入几口认条平系气题活尔更别"
+    "打女变四神总何电数安少报才结反受目太量再感建务做接必场件计管期市直德资命山金指克许统区保至队形社便空决治展马科"
+    "司五基眼书非则听白却界达光放强即像难且权思王象完设式色路记南品住告类求据程北边死张该交规万取拉格望觉术领共确传"
+    "师观清今切院让识候带导争运笑飞风步改收根干造言联持组每济车亲极林服快办议往元英士证近失转夫令准布始怎呢存未远叫"
+    "台单影具罗字爱击流备兵连调深商算质团集百需价花党华城石级整府离况亚请技际约示复病息究线似官火断精满支视消越器容"
+    "照须九增研写称企八功吗包片史委乎查轻易早曾除农找装广显吧阿李标谈吃图念六引历首医局突专费号尽另周较注语仅考落青"
+    "随选列武红响虽推势参希古众构房半节土投某案黑维革划敢险雨梦星夜歌舞春秋冬夏恋泪心情思念永远幸福快乐天使翅膀蝴蝶"
+    "月亮太阳彩虹樱桃草莓伤痕寂寞孤单温柔浪漫美丽传说青春少年童话魔法"
+    "們個這來說為國時會對後過發點裡愛聽話見東風長門間開關學無與義經現當動進體樣麼頭電雙戀淚夢幾歲歡樂傳説記憶聲"
+)
+
+# {server prefix: codec that won the last detection}, used to break ties (e.g. ascii only titles)
+server_enc_cache = {}
+
+# server prefix of an ojn filename ("Venus_o2ma1237.ojn" -> "Venus", "o2ma1237.ojn" -> "")
+def get_server(ojn_filename: str) -> str:
+    name = os.path.basename(ojn_filename)
+    if "_" not in name:
+        return ""
+    return name.split("_")[0]
+
+# bytes of a single character in a codec, None if the codec doesn't have it
+def encode_char(char: str, enc: str):
+    try:
+        return char.encode(enc)
+    except UnicodeEncodeError:
+        return None
+
+# how likely a CJK ideograph is real text in enc, based on where the codec puts it
+# (every legacy codec keeps the common characters in its first level)
+def ideograph_score(char: str, enc: str, has_hangul: bool) -> float:
+    if enc == "gb18030":
+        # GB2312 level 1 (B0-D7) / level 2 (D8-F7), anything else is a GBK extension
+        code = encode_char(char, "gb2312")
+        if code is None:
+            return -1
+        return 1.5 if code[0] <= 0xD7 else 0.5
+    if enc == "big5":
+        # big5 level 1 (A440-C67E) / level 2 (C940-F9D5)
+        code = encode_char(char, "big5")
+        if code is None or len(code) != 2:
+            return -1
+        return 1 if code[0] <= 0xC6 else 0.3
+    if enc == "shift_jis":
+        # JIS level 1 (889F-9872) / level 2 (989F-EAA4)
+        code = encode_char(char, "shift_jis")
+        if code is None or len(code) != 2:
+            return -1
+        return 1 if int.from_bytes(code, "big") <= 0x9872 else 0.3
+    if enc == "euc_kr":
+        # Hanja is rare in Korean titles, Hangul mixed with Hanja usually means Chinese text decoded as euc_kr
+        return -1 if has_hangul else 0.3
+    return 1
+
+# most frequent Hangul syllables, same idea as COMMON_HANZI
+COMMON_HANGUL = set(
+    "이다는의에고을하가지서한로기사도어리자대나아인시수게것들으해전정요내부말그제보주있일면구상만거우성중없소장원학공"
+    "국문여개연동유조생라비마스오미세진계경심실물신음선위화방발무모분관회안운약간적재결명속저작은설금강양당표단합두더"
+    "때같날람너하마눈꿈별밤바늘노래간오늘처음막영행복녕별억추그좋봄름을겨울꽃달빛길집친구엄빠녀년께혼잠들침저녁파숲불"
+    "얼슴손입술얼굴미소웃목편약속짓운명천악왕공주설작끝랑했됐줄듯잊워요까지네던될할"
+)
+
+# Hangul syllable = initial + vowel + (final), random syllables often have a rare vowel or a double final
+# rare vowels: ㅒ ㅖ ㅙ ㅞ, rare finals: ㄲ ㄳ ㄵ ㄶ ㄺ ㄻ ㄼ ㄽ ㄾ ㄿ ㅀ ㅄ ㅋ
+HANGUL_RARE_VOWELS = {3, 7, 10, 15}
+HANGUL_RARE_FINALS = {2, 3, 5, 6, 9, 10, 11, 12, 13, 14, 15, 18, 24}
+
+def hangul_score(char: str) -> float:
+    if char in COMMON_HANGUL:
+        return 2.5
+    cp = ord(char)
+    score = 1.5
+    if (cp - 0xAC00) % 588 // 28 in HANGUL_RARE_VOWELS:
+        score -= 1.5
+    if (cp - 0xAC00) % 28 in HANGUL_RARE_FINALS:
+        score -= 1.5
+    return score
+
+def char_score(char: str, enc: str, has_hangul: bool) -> float:
+    cp = ord(char)
+    if 0xE000 <= cp <= 0xF8FF or cp == 0xFFFD or unicodedata.category(char) in ("Cc", "Co", "Cn"):
+        return -5 # private use / control / unassigned
+    if 0xFF61 <= cp <= 0xFF9F:
+        return -2 # halfwidth katakana, usually single bytes of another codec read as shift_jis
+    if enc == "gb18030" and encode_char(char, "gbk") is None:
+        return -3 # 4 bytes gb18030 sequence
+    if 0xAC00 <= cp <= 0xD7A3:
+        return hangul_score(char) # Hangul syllables
+    if 0x3040 <= cp <= 0x30FF:
+        return 2 # Hiragana / Katakana
+    if 0x3130 <= cp <= 0x318F:
+        return -1 # Hangul compatibility jamo
+    if 0x4E00 <= cp <= 0x9FFF:
+        if enc != "euc_kr" and char in COMMON_HANZI:
+            return 2.5
+        return ideograph_score(char, enc, has_hangul)
+    if 0x3400 <= cp <= 0x4DBF or 0xF900 <= cp <= 0xFAFF or cp >= 0x20000:
+        return -2 # rare ideographs
+    return 0.5 # punctuation, fullwidth forms, symbols...
+
+# average score of the non-ascii characters of text decoded with enc (0 if it's all ascii)
+def score_text(text: str, enc: str) -> float:
+    chars = [c for c in text if ord(c) >= 0x80]
+    if len(chars) == 0:
+        return 0
+    has_hangul = any(0xAC00 <= ord(c) <= 0xD7A3 for c in chars)
+    score = sum(char_score(c, enc, has_hangul) for c in chars) / len(chars)
+    if enc == "utf-8":
+        score += 2 # legacy bytes are almost never valid utf-8 by accident
+    return score
+
+# pick the codec of raw (NUL-terminated, already cut) header strings, e.g. title / artist / noter
+# every field is decoded once per candidate (strict), the best scoring codec wins
+# server -> get_server() of the ojn, the winning codec is cached for that server
+# returns None if no candidate can decode all fields
+def detect_encoding(fields: list, server: str = "") -> str:
+    candidates = list(CANDIDATES)
+    hint = server_enc_cache.get(server)
+    if hint in candidates:
+        candidates.remove(hint)
+        candidates.insert(0, hint)
+
+    best_enc = None
+    best_score = None
+    for enc in candidates:
+        try:
+            text = "".join(field.decode(enc) for field in fields)
+        except UnicodeDecodeError:
+            continue
+        score = score_text(text, enc)
+        if best_score is None or score > best_score:
+            best_enc = enc
+            best_score = score
+
+    if best_enc is not None:
+        server_enc_cache[server] = best_enc
+    return best_enc
@@ -1,19 +1,24 @@
 import os
 from OJNExtract import OJNExtract
 
-cow = OJNExtract()
-cow.debug = False
+# the guard is required by o2jam_to_osu when cow.workers > 1 (worker processes import this file)
+if __name__ == "__main__":
+    cow = OJNExtract()
+    cow.debug = False
 
-'''Common Codecs
-gb18030 - Simplified Chinese
-big5 - Traditional Chinese
-euc_kr - Korean
-'''
+    '''Common Codecs
+    gb18030 - Simplified Chinese
+    big5 - Traditional Chinese
+    euc_kr - Korean
+    auto - detect from the title / artist / noter bytes (see encoding_lib)
+    '''
 
-cow.enc = "gb18030"
-cow.flag_use_mp3 = True
-cow.flag_nsv = True
-cow.extra_offset = 0
-cow.o2jam_to_osu([x for x in os.listdir(cow.input_path) if x.endswith(".ojn")])
-#cow.o2jam_to_osu(["o2ma1237.ojn"])
-#cow.input_path = r"C:\Users\Oscar\Desktop\o2jam dedupe"
\ No newline at end of file
+    cow.enc = "gb18030"
+    cow.flag_use_mp3 = True
+    cow.flag_nsv = True
+    cow.extra_offset = 0
+    cow.workers = 1 # e.g. os.cpu_count() to convert songs in parallel
+    #cow.profile_filename = "o2jampy_profile.jsonl" # per-stage timings of every song
+    cow.o2jam_to_osu([x for x in os.listdir(cow.input_path) if x.endswith(".ojn")])
+    #cow.o2jam_to_osu(["o2ma1237.ojn"])
+    #cow.input_path = r"C:\Users\Oscar\Desktop\o2jam dedupe"
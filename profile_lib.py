@@ -0,0 +1,112 @@
+import time
+import threading
+import tracemalloc
+import contextlib
+
+# Optional per-stage instrumentation of the conversion (wall time, cpu time, tracemalloc peak)
+# Disabled by default, stage() and count() do nothing until start() is called
+# e.g.
+#     with profile_lib.profiler.stage("parse_diff"):
+#         ...
+#     profile_lib.profiler.count("notes", 1234)
+# Stages can be nested, they are recorded by path ("export_osu/merge_mp3/mix")
+# and repeated stages (one per diff, per sample...) are summed up
+class StageProfiler():
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local() # stack of open stages, per thread
+        self.flag_own_tracemalloc = False
+        self.stages = {} # {path: {"calls", "wall", "cpu", "mem_peak"}}
+        self.counts = {} # {name: int}
+
+    # start recording (one song)
+    def start(self):
+        self.stages = {}
+        self.counts = {}
+        self.flag_own_tracemalloc = not tracemalloc.is_tracing()
+        if self.flag_own_tracemalloc:
+            tracemalloc.start()
+        self.enabled = True
+
+    # stop recording, returns {"stages": {path: {...}}, "counts": {...}}
+    def stop(self) -> dict:
+        self.enabled = False
+        if self.flag_own_tracemalloc:
+            tracemalloc.stop()
+            self.flag_own_tracemalloc = False
+        stages = {}
+        for path, stage in self.stages.items():
+            stages[path] = {
+                "calls": stage["calls"],
+                "wall": round(stage["wall"], 6),
+                "cpu": round(stage["cpu"], 6),
+                "mem_peak": stage["mem_peak"]
+            }
+        return {"stages": stages, "counts": dict(self.counts)}
+
+    # cpu time is process wide, so stages running in threads also count the work of the other threads
+    # tracemalloc has a single peak for the whole process, mem_peak is only approximate when stages overlap
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = []
+            self.local.stack = stack
+        path = "/".join([frame["name"] for frame in stack] + [name])
+
+        # the peak so far belongs to the parent stage, this stage is measured from here
+        current, peak = tracemalloc.get_traced_memory()
+        if len(stack) > 0:
+            stack[-1]["mem_peak"] = max(stack[-1]["mem_peak"], peak)
+        tracemalloc.reset_peak()
+
+        frame = {"name": name, "mem_peak": current}
+        stack.append(frame)
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start_wall
+            cpu = time.process_time() - start_cpu
+            stack.pop()
+            mem_peak = max(frame["mem_peak"], tracemalloc.get_traced_memory()[1])
+            if len(stack) > 0:
+                stack[-1]["mem_peak"] = max(stack[-1]["mem_peak"], mem_peak)
+
+            with self.lock:
+                if path not in self.stages:
+                    self.stages[path] = {"calls": 0, "wall": 0, "cpu": 0, "mem_peak": 0}
+                stage = self.stages[path]
+                stage["calls"] += 1
+                stage["wall"] += wall
+                stage["cpu"] += cpu
+                stage["mem_peak"] = max(stage["mem_peak"], mem_peak)
+
+    # names of the stages open in the current thread, see inherit()
+    def get_stack(self) -> list:
+        return [frame["name"] for frame in getattr(self.local, "stack", None) or []]
+
+    # record the stages of a pool thread under the stages that were open when the work was submitted
+    # e.g. stack = profiler.get_stack() before executor.submit(), then "with profiler.inherit(stack):" in the thread
+    @contextlib.contextmanager
+    def inherit(self, stack):
+        prev_stack = getattr(self.local, "stack", None)
+        self.local.stack = [{"name": name, "mem_peak": 0} for name in stack]
+        try:
+            yield
+        finally:
+            self.local.stack = prev_stack
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+profiler = StageProfiler()
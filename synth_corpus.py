@@ -0,0 +1,290 @@
+import os
+import io
+import math
+import wave
+import random
+import struct
+import argparse
+from OJMExtract import OJMExtract
+
+# Synthetic OJN/OJM generator (for benchmarks and regression checks)
+# The real charts can't be redistributed, so this writes files with the same layout
+# that OJNExtract.parse_ojn_header / parse_diff and OJMExtract.build_index read
+
+
+NAMI = b"nami"
+
+# same table as OJMExtract.rearrange
+REARRANGE_TABLE = OJMExtract().REARRANGE_TABLE
+
+
+def nami_encode(data: bytes) -> bytes:
+    out = bytearray(data)
+    for i in range(0, len(out) - 3, 4):
+        for j in range(4):
+            out[i + j] ^= NAMI[j]
+    return bytes(out)
+
+
+# inverse of OJMExtract.acc_xor (key byte is the previous *encoded* byte)
+# state -> [keybyte, counter], carried over from one wav to the next
+def acc_encode(plain: bytes, state: list) -> bytes:
+    keybyte, counter = state
+    out = bytearray(len(plain))
+    for i in range(len(plain)):
+        b = plain[i]
+        if ((keybyte << counter) & 0x80) != 0:
+            b = 255 - b
+        out[i] = b
+        counter += 1
+        if counter > 7:
+            counter = 0
+            keybyte = b
+    state[0] = keybyte
+    state[1] = counter
+    return bytes(out)
+
+
+# inverse of OJMExtract.rearrange
+def rearrange_encode(plain: bytes) -> bytes:
+    length = len(plain)
+    key = ((length % 17) << 4) + (length % 17)
+    block_size = length // 17
+    out = bytearray(plain)
+    for block in range(17):
+        src = block_size * REARRANGE_TABLE[key + block]
+        out[block_size * block:block_size * (block + 1)] = plain[src:src + block_size]
+    return bytes(out)
+
+
+# sine wave, 16 bit (or 8 bit unsigned) pcm
+def make_pcm(rng, frames, channels=1, width=2):
+    freq = rng.uniform(110, 880)
+    amp = 8000 if width == 2 else 60
+    buf = bytearray()
+    for i in range(frames):
+        v = int(amp * math.sin(2 * math.pi * freq * i / 44100))
+        for c in range(channels):
+            if width == 1:
+                buf += struct.pack("<B", v + 128)
+            else:
+                buf += struct.pack("<h", v)
+    return bytes(buf)
+
+
+def make_wav(pcm, channels=1, width=2, rate=44100):
+    f = io.BytesIO()
+    with wave.open(f, "wb") as w:
+        w.setnchannels(channels)
+        w.setsampwidth(width)
+        w.setframerate(rate)
+        w.writeframes(pcm)
+    return f.getvalue()
+
+
+# minimal ogg-looking payload (vorbis identification header + noise)
+# this is NOT decodable audio, it only has a valid identification header
+def make_fake_ogg(rng, size, bitrate=128000):
+    ident = b"\x01vorbis" + struct.pack("<IBIiii", 0, 2, 44100, 0, bitrate, 0) + b"\xb8\x01"
+    page = b"OggS\x00\x02" + bytes(20) + b"\x01" + bytes([len(ident)]) + ident
+    return page + bytes(rng.getrandbits(8) for _ in range(max(0, size - len(page))))
+
+
+# real ogg when ffmpeg is available, fake one otherwise
+def make_ogg(rng, frames, bitrate=128000):
+    try:
+        from pydub import AudioSegment
+        from pydub.utils import which
+        if which("ffmpeg"):
+            seg = AudioSegment(make_pcm(rng, frames), sample_width=2, frame_rate=44100, channels=1)
+            f = io.BytesIO()
+            seg.export(f, format="ogg", bitrate=str(bitrate))
+            return f.getvalue()
+    except ImportError:
+        pass
+    return make_fake_ogg(rng, frames // 4, bitrate)
+
+
+# samples -> [(ref, codec_code, ogg_bytes)], codec_code 0 -> sample_id 1002 + ref, 5 -> 2 + ref
+def write_ojm_m30(path, samples, encrypt=True):
+    body = bytearray()
+    for ref, codec_code, data in samples:
+        body += struct.pack("<32sIHHIHHI", b"sample", len(data), codec_code, 0, 0, ref, 0, 0)
+        body += nami_encode(data) if encrypt else data
+    header = struct.pack("<4sIIIIII", b"M30\0", 1, 16 if encrypt else 32, len(samples), 28, len(body), 0)
+    with open(path, "wb") as f:
+        f.write(header + body)
+
+
+# wavs -> [wav_bytes or None] (None = empty chunk), oggs -> [ogg_bytes or None]
+# signature -> b"OMC\0" or b"OJM\0" (same layout)
+def write_ojm_omc(path, wavs, oggs, signature=b"OMC\0"):
+    state = [0xFF, 0]
+    body = bytearray()
+    for wav in wavs:
+        if wav is None:
+            body += struct.pack("<32sHHIIHHII", b"", 0, 0, 0, 0, 0, 0, 0, 0)
+            continue
+        with wave.open(io.BytesIO(wav)) as w:
+            channels = w.getnchannels()
+            width = w.getsampwidth()
+            rate = w.getframerate()
+            pcm = w.readframes(w.getnframes())
+        encoded = rearrange_encode(acc_encode(pcm, state))
+        body += struct.pack("<32sHHIIHHII", b"wav", 1, channels, rate, rate * channels * width, channels * width, width * 8, 0, len(encoded))
+        body += encoded
+    ogg_start = 20 + len(body)
+    for ogg in oggs:
+        if ogg is None:
+            body += struct.pack("<32sI", b"", 0)
+            continue
+        body += struct.pack("<32sI", b"ogg", len(ogg)) + ogg
+    header = struct.pack("<4sHHIII", signature, len(wavs), len(oggs), 20, ogg_start, 20 + len(body))
+    with open(path, "wb") as f:
+        f.write(header + body)
+
+
+# one difficulty section
+# keysounds -> sample_id - 1 of the samples used by notes (1000+ -> ogg section, note_type 4), autoplay_ids -> same for autoplay
+# returns (raw bytes, package count, event count)
+def make_diff(rng, measures, notes, ln_ratio, bpm_changes, fracs, keysounds, autoplay_ids):
+    packages = []
+    # BPM changes
+    for i in range(bpm_changes):
+        m = rng.randrange(1, measures)
+        packages.append((m, 1, [struct.pack("<f", rng.choice([90.0, 120.0, 150.0, 180.0, 240.0]))] + [struct.pack("<f", 0.0)] * 3))
+    # channel 0 fractions
+    for m in rng.sample(range(1, measures), min(fracs, measures - 1)):
+        packages.append((m, 0, [struct.pack("<f", rng.choice([0.25, 0.5, 0.75]))]))
+    # notes, 16 events per measure and lane
+    per_measure = max(1, notes // (measures * 7))
+    for m in range(measures):
+        for lane in range(7):
+            events = [struct.pack("<HBB", 0, 0, 0)] * 16
+            for _ in range(per_measure):
+                slot = rng.randrange(16)
+                sample = rng.choice(keysounds) if keysounds else 0
+                note_type = 4 if sample >= 1000 else 0
+                if rng.random() < ln_ratio:
+                    events[slot] = struct.pack("<HBB", sample % 1000, rng.randrange(256), 2)
+                    tail = rng.randrange(slot, 16)
+                    if tail > slot:
+                        events[tail] = struct.pack("<HBB", sample % 1000, 0, 3)
+                else:
+                    events[slot] = struct.pack("<HBB", sample % 1000, rng.randrange(256), note_type)
+            packages.append((m, lane + 2, events))
+    # autoplay
+    for idx, sample in enumerate(autoplay_ids):
+        m = idx % measures
+        packages.append((m, 9 + idx % 7, [struct.pack("<HBB", sample % 1000, 0, 4 if sample >= 1000 else 0)] + [struct.pack("<HBB", 0, 0, 0)] * 3))
+    packages.sort(key=lambda p: p[0])
+    raw = bytearray()
+    n_events = 0
+    for m, channel, events in packages:
+        raw += struct.pack("<IHH", m, channel, len(events)) + b"".join(events)
+        n_events += len(events)
+    return bytes(raw), len(packages), n_events
+
+
+# diffs -> [(raw, package_count, event_count, measures)] x3
+def write_ojn(path, song_id, diffs, bpm=150.0, title=b"Synthetic", artist=b"o2jampy", noter=b"bench", cover=b"", levels=(10, 40, 80)):
+    offsets = []
+    pos = 300
+    for raw, _, _, _ in diffs:
+        offsets.append(pos)
+        pos += len(raw)
+    cover_offset = pos
+    header = struct.pack("<I4sfIf4H", song_id, b"ojn\0", 2.9, 10, bpm, levels[0], levels[1], levels[2], 0)
+    header += struct.pack("<3I", *[d[2] for d in diffs])
+    header += struct.pack("<3I", *[d[2] for d in diffs])
+    header += struct.pack("<3I", *[d[3] for d in diffs])
+    header += struct.pack("<3I", *[d[1] for d in diffs])
+    header += struct.pack("<HH20sII", 29, 0, b"", 0, 0)
+    header += struct.pack("<64s32s32s32s", title, artist, noter, f"o2ma{song_id}.ojm".encode())
+    header += struct.pack("<I3I3II", len(cover), 120, 120, 120, *offsets, cover_offset)
+    with open(path, "wb") as f:
+        f.write(header)
+        for raw, _, _, _ in diffs:
+            f.write(raw)
+        f.write(cover)
+
+
+# write o2ma{song_id}.ojn + o2ma{song_id}.ojm into out_dir
+# ojm_format -> "m30" (ogg only), "omc" / "ojm" (wav + ogg)
+# notes -> notes of the hardest diff (Easy / Normal get 1/3 and 2/3)
+# wav_ratio -> share of wav samples (omc / ojm only)
+# sample_ms -> max length of a sample
+def generate_song(out_dir, song_id, ojm_format="m30", notes=3000, ln_ratio=0.2, bpm_changes=4, fracs=2, samples=40, wav_ratio=0.5, sample_ms=500, encrypt=True, cover_size=100000, seed=0):
+    rng = random.Random(seed * 1000 + song_id)
+    max_frames = max(1, 44100 * sample_ms // 1000)
+
+    if ojm_format == "m30":
+        # M30 has no wav, codec_code 0 -> sample_id 1002+ (same ids as the ogg section of omc)
+        m30_samples = [(i, 0, make_ogg(rng, rng.randrange(1, max_frames))) for i in range(samples)]
+        write_ojm_m30(os.path.join(out_dir, f"o2ma{song_id}.ojm"), m30_samples, encrypt)
+        keysounds = [1001 + i for i in range(samples)]
+    else:
+        wav_count = round(samples * wav_ratio)
+        wavs = [make_wav(make_pcm(rng, rng.randrange(1, max_frames))) for i in range(wav_count)]
+        oggs = [make_ogg(rng, rng.randrange(1, max_frames)) for i in range(samples - wav_count)]
+        write_ojm_omc(os.path.join(out_dir, f"o2ma{song_id}.ojm"), wavs, oggs, b"OMC\0" if ojm_format == "omc" else b"OJM\0")
+        # sample_id = sample_value + 1 (wav starts from 2, ogg from 1002)
+        keysounds = [1 + i for i in range(wav_count)] + [1001 + i for i in range(samples - wav_count)]
+
+    # a few background samples
+    autoplay_ids = keysounds[:min(8, len(keysounds))]
+
+    diffs = []
+    for diff_idx in range(3):
+        diff_notes = notes * (diff_idx + 1) // 3
+        measures = max(2, diff_notes // 20) + diff_idx # different sizes, so no diff is skipped as a duplicate
+        raw, package_count, event_count = make_diff(rng, measures, diff_notes, ln_ratio, bpm_changes, fracs, keysounds, autoplay_ids)
+        diffs.append((raw, package_count, event_count, measures))
+
+    cover = bytes(rng.getrandbits(8) for _ in range(cover_size))
+    write_ojn(os.path.join(out_dir, f"o2ma{song_id}.ojn"), song_id, diffs, cover=cover)
+    return f"o2ma{song_id}.ojn"
+
+
+# returns the list of .ojn filenames
+def generate_corpus(out_dir, songs=4, **kwargs):
+    os.makedirs(out_dir, exist_ok=True)
+    formats = ["m30", "omc", "ojm"]
+    ojn_list = []
+    for song_id in range(1, songs + 1):
+        song_kwargs = dict(kwargs)
+        song_kwargs.setdefault("ojm_format", formats[(song_id - 1) % len(formats)])
+        ojn_list.append(generate_song(out_dir, song_id, **song_kwargs))
+    return ojn_list
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic OJN/OJM corpus")
+    parser.add_argument("out_dir")
+    parser.add_argument("--songs", type=int, default=4)
+    parser.add_argument("--format", choices=["m30", "omc", "ojm"], default=None, help="default: rotate m30 / omc / ojm")
+    parser.add_argument("--notes", type=int, default=3000)
+    parser.add_argument("--ln-ratio", type=float, default=0.2)
+    parser.add_argument("--bpm-changes", type=int, default=4)
+    parser.add_argument("--fracs", type=int, default=2)
+    parser.add_argument("--samples", type=int, default=40)
+    parser.add_argument("--wav-ratio", type=float, default=0.5)
+    parser.add_argument("--sample-ms", type=int, default=500)
+    parser.add_argument("--plain", action="store_true", help="M30 without nami encryption")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    kwargs = {
+        "notes": args.notes,
+        "ln_ratio": args.ln_ratio,
+        "bpm_changes": args.bpm_changes,
+        "fracs": args.fracs,
+        "samples": args.samples,
+        "wav_ratio": args.wav_ratio,
+        "sample_ms": args.sample_ms,
+        "encrypt": not args.plain,
+        "seed": args.seed
+    }
+    if args.format is not None:
+        kwargs["ojm_format"] = args.format
+    print(generate_corpus(args.out_dir, args.songs, **kwargs))